@@ -0,0 +1,61 @@
+import multiprocessing
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from geometry import normalSurfaces
+import output
+
+# Output of snapshot steps in the background: the deformed surface is copied to a snapshot buffer, then rendered (POV-Ray) and written (.txt, surface files) by a pool of workers
+# while the loop goes on. There is one buffer per worker plus one, and a buffer is only refilled once its previous output is written, so the loop waits (and memory stays bounded)
+# only when the workers fall behind. Normals are computed by the loop: the workers run no numba kernels, whose parallel layer may not be shared between threads
+
+pool = [None]  # Executor of the output jobs
+slots = []  # Per snapshot buffer: [surface positions, step, pending output]
+turn = [0]  # Next buffer to fill
+
+# Start the output workers: threads, or processes (spawned, so that they do not inherit the numba threads of the loop)
+def startOutput(workers=1, processes=False):
+  if processes:
+    pool[0] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+  else:
+    pool[0] = ThreadPoolExecutor(max_workers=workers)
+  slots[:] = [[None, None, None] for i in range(workers + 1)]
+  turn[0] = 0
+
+# Write the outputs of one snapshot: surface positions Us and normals Ns of the nsn surface nodes, surface triangles fs in surface node indices
+# With meshes, also the .txt file and the surface files in the given formats (see output.surfaceWriters)
+def writeSnapshot(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Us, Ns, fs, nsn, zoom, zoom_pos, cog, maxd, miny, halforwholebrain, meshes=True, formats=('stl',)):
+  index = np.arange(nsn)
+  output.writePov(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Us, fs, index, index, nsn, zoom, zoom_pos, Ns)
+  if not meshes:
+    return
+  output.writeTXT(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Us, fs, index, index, nsn, zoom_pos)
+  output.mesh_to_surface(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Us, index, zoom_pos, cog, maxd, nsn, fs, miny, halforwholebrain, formats)
+
+# Wait for the output of a buffer, a failed output is reported and the run goes on
+def waitSlot(slot):
+  if slot[2] is not None:
+    try:
+      slot[2].result()
+    except Exception as e:
+      print ('Output of step ' + str(slot[1]) + ' failed: ' + str(e))
+    slot[2] = None
+
+# Copy the surface of the current state (Ut) to the next snapshot buffer and queue its outputs (same files as writePov, and writeTXT and mesh_to_surface with meshes)
+def submitOutput(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, fs, nsn, zoom, zoom_pos, cog, maxd, miny, halforwholebrain, meshes=True, formats=('stl',)):
+  slot = slots[turn[0]]
+  turn[0] = (turn[0] + 1) % len(slots)
+  waitSlot(slot)
+  if slot[0] is None or slot[0].dtype != Ut.dtype:
+    slot[0] = np.zeros((nsn,3), dtype = Ut.dtype)
+  np.take(Ut, SN, axis=0, out=slot[0])
+  slot[1] = step
+  Ns = normalSurfaces(Ut, faces, SNb, len(faces), nsn, np.zeros((nsn,3), dtype = float))
+  slot[2] = pool[0].submit(writeSnapshot, PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, slot[0], Ns, fs, nsn, zoom, zoom_pos, cog, maxd, miny, halforwholebrain, meshes, formats)
+
+# Wait for all queued outputs and stop the workers
+def finishOutput():
+  for slot in slots:
+    waitSlot(slot)
+  if pool[0] is not None:
+    pool[0].shutdown()
+    pool[0] = None
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+  python benchmark.py -s 10k 100k -ns 20 -o './res/benchmark.json'
+  python benchmark.py -s 10k 100k 1M 3M -sh ellipsoid -th 1 2 4 8 -o './res/benchmark_ellipsoid.json' -c './res/benchmark.json'
+
+"""
+
+from __future__ import division
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import numba
+from geometry import numberSurfaceNodes, vertexTetraCSR, vertexFacesCSR, meshToBinary, markgrowth, configRefer, configReferInverse, refreshReferCache, configDeform, normalSurfaces, tetraNormals, tangentProjector, volumeNodal, volumeNodalGather
+from growth import dist2surf, growthRate, cortexThickness, shearModulus, growthTensor_tangenProj
+from normalisation import normalise_coord
+from collision_Tallinen import contactProcess, contactForces
+from mechanics import tetraElasticity, tetraElasticityFused
+
+SIMULATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulation.py')
+
+# Semi-axes of the synthetic meshes, in the proportions of data/sphere5.mesh for the ellipsoid
+SHAPES = {'sphere': (1.0, 1.0, 1.0), 'ellipsoid': (0.9, 1.0, 0.72)}
+
+# Synthetic tetrahedral ball: an n*n*n grid of cubes, each split into 6 tetrahedra along its main diagonal (conforming), mapped onto the ball and scaled to the semi-axes radii
+# Same conventions as the meshes of the repository (see data/sphere5.mesh): tetrahedra have negative volumes and the normals of surface triangles point inwards
+def ballMesh(n, radii=(1.0, 1.0, 1.0)):
+  g = np.linspace(-1.0, 1.0, n+1)
+  x, y, z = [c.ravel() for c in np.meshgrid(g, g, g, indexing='ij')]
+  x2, y2, z2 = x*x, y*y, z*z
+  Ut0 = np.stack((x*np.sqrt(1.0 - y2/2.0 - z2/2.0 + y2*z2/3.0), y*np.sqrt(1.0 - z2/2.0 - x2/2.0 + z2*x2/3.0), z*np.sqrt(1.0 - x2/2.0 - y2/2.0 + x2*y2/3.0)), axis=1)*np.asarray(radii)
+
+  # Tetrahedra: paths from corner (0,0,0) to corner (1,1,1) of each cube, one per order of the axes
+  i, j, k = [c.ravel() for c in np.meshgrid(np.arange(n), np.arange(n), np.arange(n), indexing='ij')]
+  tets = []
+  for order in itertools.permutations(range(3)):
+    e = [0, 0, 0]
+    v = [(i*(n+1) + j)*(n+1) + k]
+    for axis in order:
+      e[axis] = 1
+      v.append(((i+e[0])*(n+1) + j+e[1])*(n+1) + k+e[2])
+    tets.append(np.stack(v, axis=1))
+  tets = np.concatenate(tets)
+  P = Ut0[tets]
+  vol = np.einsum('ij,ij->i', P[:,1] - P[:,0], np.cross(P[:,2] - P[:,0], P[:,3] - P[:,0]))
+  tets[vol > 0.0] = tets[vol > 0.0][:,[0,1,3,2]]
+
+  # Surface triangles: faces of tetrahedra lying on a side of the grid, oriented towards the opposite vertex
+  grid = np.stack((np.arange(len(Ut0))//((n+1)*(n+1)), np.arange(len(Ut0))//(n+1)%(n+1), np.arange(len(Ut0))%(n+1)), axis=1)
+  faces = []
+  for opposite in range(4):
+    f = tets[:, [c for c in range(4) if c != opposite]]
+    side = np.zeros(len(f), dtype=bool)
+    for axis in range(3):
+      c = grid[f, axis]
+      side |= (c[:,0] == c[:,1]) & (c[:,1] == c[:,2]) & ((c[:,0] == 0) | (c[:,0] == n))
+    f = f[side]
+    o = tets[side, opposite]
+    inward = np.einsum('ij,ij->i', np.cross(Ut0[f[:,1]] - Ut0[f[:,0]], Ut0[f[:,2]] - Ut0[f[:,0]]), Ut0[o] - Ut0[f[:,0]])
+    f[inward < 0.0] = f[inward < 0.0][:,[0,2,1]]
+    faces.append(f)
+  faces = np.concatenate(faces)
+
+  return Ut0, tets.astype(np.int64), faces.astype(np.int64)
+
+# Number of cubes per side of ballMesh for about ntets tetrahedra
+def cubesPerSide(ntets):
+  return max(1, int(round((ntets/6.0)**(1.0/3.0))))
+
+# Number of tetrahedra from a size such as 10k, 1M or 3000000
+def parseSize(size):
+  scale = {'k': 1e3, 'K': 1e3, 'm': 1e6, 'M': 1e6}
+  if size[-1] in scale:
+    return int(float(size[:-1])*scale[size[-1]])
+  return int(size)
+
+# Time a kernel: one call for compilation, then the minimum and median of repeat calls
+def timeKernel(f, repeat):
+  f()
+  times = []
+  for r in range(repeat):
+    tic = time.perf_counter()
+    f()
+    times.append(time.perf_counter() - tic)
+
+  return {'min': min(times), 'median': float(np.median(times))}
+
+# Time the kernels of a step in isolation, for each number of numba threads, in the state of the loop halfway through growth (t = 0.5)
+# Kernels failing to run are reported with their error instead of a time
+def benchKernels(Ut0, tets, faces, a, threads, repeat):
+  nn, ne, nf = len(Ut0), len(tets), len(faces)
+  nsn, SN, SNb = numberSurfaceNodes(faces, nn, nf)
+  VT_ptr, VT_idx = vertexTetraCSR(tets, nn)
+  FN_ptr, FN_idx = vertexFacesCSR(faces, SNb, nsn)
+  csn, d2s = dist2surf(Ut0, SN)
+  gr = markgrowth(Ut0, nn)
+  A0 = configRefer(Ut0, tets, ne)
+  A0inv, detA0 = configReferInverse(A0, ne)
+
+  # Parameters of simulation.py
+  K = 5.0
+  k = 0.0
+  eps = 0.1
+  hs = 0.6*a
+  hc = 0.2*a
+  kc = 10.0*K
+  mw = 8*a
+  bw = 3.2
+  H = cortexThickness(0.042, 0.5)
+  gm, mu = shearModulus(d2s, H, tets, ne, 1.167, 1.0, gr)
+
+  # Grown state and slightly perturbed positions, so that all force terms are active
+  N0 = normalSurfaces(Ut0, faces, SNb, nf, nsn, np.zeros((nsn,3), dtype = np.float64))
+  Pt = tangentProjector(tetraNormals(N0, csn, tets, ne), ne)
+  G = np.zeros((ne,3,3), dtype = np.float64)
+  G[:,np.arange(3),np.arange(3)] = 1.0
+  Gc = G.copy()
+  G = growthTensor_tangenProj(Pt, gm, growthRate(1.829, 0.5, ne), G, ne)
+  Arinv, vol0, nrefresh = refreshReferCache(G, A0inv, detA0, Gc, A0inv.copy(), detA0/6.0, ne, 0.0)
+  Ut = Ut0 + 0.1*a*np.random.RandomState(0).standard_normal((nn,3))
+  vol = np.zeros(ne, dtype = np.float64)
+  Vn0, Vn = volumeNodalGather(vol0, tets, Ut, ne, nn, VT_ptr, VT_idx, vol)
+  Ft = np.zeros((nn,3), dtype = np.float64)
+  Fe = np.zeros((4*ne,3), dtype = np.float64)
+  Utold = np.zeros((nsn,3), dtype = np.float64)
+  stats = np.zeros(3, dtype = np.float64)
+  Ft, NNLt = contactProcess(Ut, Ft, SN, np.full((nsn,3), np.inf), nsn, (np.zeros(nsn+1, dtype = np.int64), np.zeros(0, dtype = np.int64)), faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, stats)
+
+  # Proximity lists are recomputed at every call of contactProcess (Utold far away), contactForces reuses them
+  def contactUpdate():
+    Utold[:] = np.inf
+    contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, stats)
+
+  kernels = {'tetraElasticity': lambda: tetraElasticity(configDeform(Ut, tets, ne), A0, Ft, G, K, k, mu, tets, Vn, Vn0, ne, eps),
+             'tetraElasticityFused': lambda: tetraElasticityFused(Ut, tets, Arinv, vol0, Ft, K, k, mu, Vn, Vn0, ne, eps, Fe, VT_ptr, VT_idx),
+             'volumeNodal': lambda: volumeNodal(G, A0, tets, Ut, ne, nn),
+             'volumeNodalGather': lambda: volumeNodalGather(vol0, tets, Ut, ne, nn, VT_ptr, VT_idx, vol),
+             'contactProcess': contactUpdate,
+             'contactForces': lambda: contactForces(Ut, Ft, SN, *NNLt, faces, FN_ptr, FN_idx, nsn, hc, kc, a, gr),
+             'normalSurfaces': lambda: normalSurfaces(Ut, faces, SNb, nf, nsn, np.zeros((nsn,3), dtype = np.float64)),
+             'dist2surf': lambda: dist2surf(Ut, SN)}
+
+  results = {}
+  for name, f in kernels.items():
+    results[name] = {}
+    for n in threads:
+      numba.set_num_threads(n)
+      try:
+        results[name][str(n)] = timeKernel(f, repeat)
+      except Exception as e:
+        results[name][str(n)] = {'error': repr(e)}
+        break
+    base = results[name][str(threads[0])].get('median')
+    for n in threads:
+      if base and 'median' in results[name].get(str(n), {}):
+        results[name][str(n)]['speedup'] = base/results[name][str(n)]['median']
+    print (name + ': ' + ', '.join(str(n) + ' threads ' + ('%.4f s' % results[name][str(n)]['median'] if 'median' in results[name][str(n)] else results[name][str(n)]['error']) for n in threads if str(n) in results[name]))
+  numba.set_num_threads(numba.config.NUMBA_NUM_THREADS)
+
+  return {'nsn': int(nsn), 'kernels': results}
+
+# Run nsteps steps of simulation.py on the mesh with nthreads numba threads, and read its timing log (see profiling.py)
+# Snapshot outputs are disabled (-di 0, -ow 0), so that only the simulation is timed. The first step (compilation) is left out of the time per step, which is the median over the other steps
+def benchSteps(mesh_path, outdir, nsteps, nthreads, a):
+  env = dict(os.environ, NUMBA_NUM_THREADS=str(nthreads))
+  tic = time.perf_counter()
+  subprocess.run([sys.executable, SIMULATION, '-i', mesh_path, '-o', outdir, '-hc', 'whole', '-gm', 'global', '-ms', str(a), '-ns', str(nsteps), '-pf', '1', '-ow', '0', '-di', '0'], env=env, stdout=subprocess.DEVNULL, check=True)
+  total = time.perf_counter() - tic
+  with open(os.path.join(outdir, 'profile.json')) as f:
+    phases = list(json.load(f)['phases']) + ['other']
+  with open(os.path.join(outdir, 'profile.csv')) as f:
+    header = f.readline().strip().split(',')
+    rows = [dict(zip(header, [float(x) for x in line.strip().split(',')])) for line in f if line.strip()]
+  steady = rows[1:] if len(rows) > 1 else rows
+
+  return {'total': total, 'steps': len(rows), 'per_step': float(np.median([row['wall'] for row in steady])), 'phases': {name: float(np.median([row.get(name, 0.0) for row in steady])) for name in phases}}
+
+# Print the speedups of a report with respect to a previous one (previous time / new time), for the kernels and steps they share
+def compareReports(report, previous):
+  for mesh in report['meshes']:
+    if mesh not in previous['meshes']:
+      continue
+    new = report['meshes'][mesh]
+    old = previous['meshes'][mesh]
+    for name in new['kernels']:
+      for n in new['kernels'][name]:
+        a = new['kernels'][name][n]
+        b = old['kernels'].get(name, {}).get(n, {})
+        if 'median' in a and 'median' in b:
+          print (mesh + ' ' + name + ' ' + n + ' threads: ' + '%.2f' % (b['median']/a['median']) + 'x')
+    for n in new.get('steps', {}):
+      if n in old.get('steps', {}):
+        print (mesh + ' step ' + n + ' threads: ' + '%.2f' % (old['steps'][n]['per_step']/new['steps'][n]['per_step']) + 'x')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of the simulation kernels on synthetic tetrahedral meshes')
+  parser.add_argument('-s', '--sizes', help='Numbers of tetrahedra of the synthetic meshes, e.g. 10k 100k 1M 3M', type=str, nargs='+', default=['10k', '100k', '1M', '3M'], required=False)
+  parser.add_argument('-sh', '--shape', help='Sphere or ellipsoid', type=str, choices=sorted(SHAPES), default='sphere', required=False)
+  parser.add_argument('-th', '--threads', help='Numbers of numba threads of the scaling curves (default: 1, 2, 4... up to all threads)', type=int, nargs='+', required=False)
+  parser.add_argument('-r', '--repeat', help='Timed calls of each kernel', type=int, default=5, required=False)
+  parser.add_argument('-ns', '--nsteps', help='Full steps of simulation.py run on each mesh (0: kernels only)', type=int, default=10, required=False)
+  parser.add_argument('-ms', '--meshspacing', help='Mesh spacing parameter passed to the contact detection and to simulation.py', type=float, default=0.01, required=False)
+  parser.add_argument('-o', '--output', help='JSON report', type=str, default='./res/benchmark.json', required=False)
+  parser.add_argument('-c', '--compare', help='Previous JSON report to compare with', type=str, required=False)
+  args = parser.parse_args()
+
+  maxthreads = numba.config.NUMBA_NUM_THREADS
+  threads = args.threads or sorted(set([2**p for p in range(maxthreads.bit_length()) if 2**p <= maxthreads] + [maxthreads]))
+  threads = [n for n in threads if n <= maxthreads]
+
+  report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'numba': numba.__version__, 'threading_layer': numba.config.THREADING_LAYER,
+            'shape': args.shape, 'repeat': args.repeat, 'nsteps': args.nsteps, 'meshspacing': args.meshspacing, 'threads': threads, 'meshes': {}}
+
+  workdir = tempfile.mkdtemp(prefix='braingrowth_benchmark_')
+  for size in args.sizes:
+    n = cubesPerSide(parseSize(size))
+    tic = time.perf_counter()
+    Ut0, tets, faces = ballMesh(n, SHAPES[args.shape])
+    generation = time.perf_counter() - tic
+    name = args.shape + '-' + size
+    print (name + ': ' + str(len(Ut0)) + ' nodes, ' + str(len(tets)) + ' tetrahedra, ' + str(len(faces)) + ' surface triangles')
+    mesh = {'cubes': n, 'nn': len(Ut0), 'ne': len(tets), 'nf': len(faces), 'generation': generation}
+
+    # Raw mesh for simulation.py, as binary sidecar files
+    mesh_path = os.path.join(workdir, name + '.mesh')
+    meshToBinary(mesh_path, Ut0, tets, faces)
+
+    # Kernels on the normalized mesh, as in the simulation
+    Ut0, Ut, cog, maxd, miny = normalise_coord(Ut0, Ut0.copy(), len(Ut0), 'whole')
+    mesh.update(benchKernels(Ut0, tets, faces, args.meshspacing, threads, args.repeat))
+
+    if args.nsteps > 0:
+      mesh['steps'] = {}
+      for nthreads in threads:
+        mesh['steps'][str(nthreads)] = benchSteps(mesh_path, os.path.join(workdir, name + '-' + str(nthreads)), args.nsteps, nthreads, args.meshspacing)
+        print (name + ' step: ' + str(nthreads) + ' threads ' + '%.4f s' % (mesh['steps'][str(nthreads)]['per_step']))
+      base = mesh['steps'][str(threads[0])]['per_step']
+      for nthreads in threads:
+        mesh['steps'][str(nthreads)]['speedup'] = base/mesh['steps'][str(nthreads)]['per_step']
+
+    report['meshes'][name] = mesh
+
+    folder = os.path.dirname(args.output)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  print ('Report written to ' + args.output)
+  if args.compare:
+    with open(args.compare) as f:
+      compareReports(report, json.load(f))
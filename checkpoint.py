@@ -0,0 +1,68 @@
+import os
+import time
+import threading
+import numpy as np
+
+# Checkpoints of long runs: the state of the loop is copied to snapshot buffers (the only part the loop waits for), then written in a background thread
+# A checkpoint is written to path.tmp and renamed over path once complete, so a crash during a write leaves the previous checkpoint intact
+
+buffers = {}  # Snapshot buffers by name, reused from one checkpoint to the next
+writer = [None, None]  # Thread of the pending write, and the error it raised
+
+# Copy the state (a dict of arrays and scalars) to the snapshot buffers, then write it to path in the background (np.savez, or np.savez_compressed with compress)
+# Returns the time spent in the copy, in seconds, or None if the previous write, which reads the same buffers, is still running: nothing is saved then,
+# the loop goes on without waiting and tries again later
+def saveCheckpoint(path, state, compress=False):
+  if writingCheckpoint():
+    return None
+  waitCheckpoint()
+  tic = time.perf_counter()
+  for name, value in state.items():
+    value = np.asarray(value)
+    if name not in buffers or buffers[name].shape != value.shape or buffers[name].dtype != value.dtype:
+      buffers[name] = np.empty_like(value)
+    np.copyto(buffers[name], value)
+  for name in list(buffers):
+    if name not in state:
+      del buffers[name]
+  snapshot = time.perf_counter() - tic
+  writer[0] = threading.Thread(target=writeCheckpoint, args=(path, dict(buffers), compress))
+  writer[0].start()
+
+  return snapshot
+
+# Write a snapshot to path.tmp, flush it to disk and rename it over path
+def writeCheckpoint(path, snapshot, compress):
+  try:
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+      if compress:
+        np.savez_compressed(f, **snapshot)
+      else:
+        np.savez(f, **snapshot)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp, path)
+  except Exception as e:
+    writer[1] = e
+
+# Whether a write is still running
+def writingCheckpoint():
+  return writer[0] is not None and writer[0].is_alive()
+
+# Wait for the pending write, if any. A failed write is reported, the run goes on with the previous checkpoint kept on disk
+def waitCheckpoint():
+  if writer[0] is not None:
+    writer[0].join()
+    writer[0] = None
+  if writer[1] is not None:
+    print ('Checkpoint write failed: ' + str(writer[1]))
+    writer[1] = None
+
+# Read a checkpoint written by saveCheckpoint, as a dict of arrays (scalars are 0-d arrays)
+def loadCheckpoint(path):
+  with np.load(path) as f:
+    return {name: f[name] for name in f.files}
@@ -1,8 +1,10 @@
 from mathfunc import closestPointTriangle, cross_dim_2, norm_dim_3
+from collision_Tallinen import contactForces, contactLists
 import numpy as np
 import math
+import time
 from numba import jit, njit, prange
-from sklearn.neighbors import KDTree
+from scipy.spatial import cKDTree
 import sys
 
 # Generates point-triangle proximity lists (NNLt) using the linked cell algorithm
@@ -29,57 +31,92 @@ def createNNLtriangle(NNLt, Ut, faces, SN, nsn, nf, hs, bw, mw):
     ya = int((Ut[pt,1]+0.5*bw)/bw*mx)
     za = int((Ut[pt,2]+0.5*bw)/bw*mx)
 
-    for xi, yi, zi in zip(range(max(0,xa-1), min(mx-1, xa+1)+1), range(max(0,ya-1), min(mx-1, ya+1)+1), range(max(0,za-1), min(mx-1, za+1)+1)): # Browse head list
-      tri = head[mx*mx*zi + mx*yi + xi]
-      while tri != -1:
-        if pt != faces[tri,0] and pt != faces[tri,1] and pt != faces[tri,2]:
-          pc, ubt, vbt, wbt = closestPointTriangle(Ut[pt], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)
-          if np.linalg.norm(pc - Ut[pt]) < hs:
-            NNLt[i].append(tri)
-        tri = lists[tri]
+    for zi in range(max(0,za-1), min(mx-1, za+1)+1): # Browse head list of the 27 neighbouring cells
+      for yi in range(max(0,ya-1), min(mx-1, ya+1)+1):
+        for xi in range(max(0,xa-1), min(mx-1, xa+1)+1):
+          tri = head[mx*mx*zi + mx*yi + xi]
+          while tri != -1:
+            if pt != faces[tri,0] and pt != faces[tri,1] and pt != faces[tri,2]:
+              pc, ubt, vbt, wbt = closestPointTriangle(Ut[pt], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)
+              if np.linalg.norm(pc - Ut[pt]) < hs:
+                NNLt[i].append(tri)
+            tri = lists[tri]
 
   return NNLt
 
 
-# Calculate contact forces
+# Point-triangle proximity lists (NNLt_ptr, NNLt_idx) from point-point neighbour lists (nb_ptr, nb_idx): triangles incident to the neighbours of each surface node (FN_ptr, FN_idx), merged, without duplicates and without the triangles the node belongs to
+@njit(parallel=True)
+def neighbourTriangles(nb_ptr, nb_idx, FN_ptr, FN_idx, SN, faces, nsn):
+  # Upper bound of the list sizes, then candidate triangles of each node in its own slice
+  bound = np.zeros(nsn+1, dtype=np.int64)
+  for i in range(nsn):
+    n = 0
+    for p in range(nb_ptr[i], nb_ptr[i+1]):
+      n += FN_ptr[nb_idx[p]+1] - FN_ptr[nb_idx[p]]
+    bound[i+1] = bound[i] + n
+  cand = np.zeros(bound[nsn], dtype=np.int64)
+  count = np.zeros(nsn, dtype=np.int64)
+  for i in prange(nsn):
+    q = bound[i]
+    for p in range(nb_ptr[i], nb_ptr[i+1]):
+      for r in range(FN_ptr[nb_idx[p]], FN_ptr[nb_idx[p]+1]):
+        cand[q] = FN_idx[r]
+        q += 1
+    # Sort, remove duplicates and the triangles containing the point itself
+    cand[bound[i]:q] = np.sort(cand[bound[i]:q])
+    pt = SN[i]
+    n = 0
+    prev = -1
+    for r in range(bound[i], q):
+      tri = cand[r]
+      if tri != prev and pt != faces[tri,0] and pt != faces[tri,1] and pt != faces[tri,2]:
+        cand[bound[i]+n] = tri
+        n += 1
+      prev = tri
+    count[i] = n
+
+  NNLt_ptr = np.zeros(nsn+1, dtype=np.int64)
+  for i in range(nsn):
+    NNLt_ptr[i+1] = NNLt_ptr[i] + count[i]
+  NNLt_idx = np.zeros(NNLt_ptr[nsn], dtype=np.int64)
+  for i in prange(nsn):
+    NNLt_idx[NNLt_ptr[i]:NNLt_ptr[i+1]] = cand[bound[i]:bound[i]+count[i]]
+
+  return NNLt_ptr, NNLt_idx
+
+# Generates point-triangle proximity lists (NNLt_ptr, NNLt_idx) with a Kd-tree: triangles incident to the surface nodes closer than r
+def createNNLtriangleKDTree(Ut, SN, faces, nsn, r, FN_ptr, FN_idx):
+  pairs = cKDTree(Ut[SN[:]]).query_pairs(r, output_type='ndarray')  # Point-point proximity pairs (i < j)
+  src = np.concatenate((pairs[:,0], pairs[:,1]))
+  dst = np.concatenate((pairs[:,1], pairs[:,0]))
+  order = np.argsort(src, kind='stable')
+  nb_ptr = np.zeros(nsn+1, dtype=np.int64)
+  nb_ptr[1:] = np.cumsum(np.bincount(src, minlength=nsn))
+  nb_idx = dst[order].astype(np.int64)
+
+  return neighbourTriangles(nb_ptr, nb_idx, FN_ptr, FN_idx, SN, faces, nsn)
+
+# Calculate contact forces, point-triangle proximity lists (NNLt) are kept in compressed sparse row form (NNLt_ptr, NNLt_idx) with their contact workspace (see collision_Tallinen.contactLists)
+# FN_ptr, FN_idx: triangles incident to each surface node (see geometry.vertexFacesCSR), computed once
+# All the lists are rebuilt once a surface node moves more than 0.5*(hs-hc), node by node refreshes are only done by the linked cells (collision_Tallinen.contactProcess)
+# stats: number of list updates, number of recomputed node lists and time spent in proximity detection, accumulated
 #@jit
-def contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr):
+def contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, stats):
   maxDist = 0.0
-  ub = vb = wb = 0.0  # Barycentric coordinates of triangles
   maxDist = max(norm_dim_3(Ut[SN[:]] - Utold[:]))
   if maxDist > 0.5*(hs-hc):
+    tic = time.time()
     #NNLt = createNNLtriangle(NNLt, Ut, faces, SN, nsn, nf, hs, bw, mw) # Generates point-triangle proximity lists (NNLt[nsn]) using the linked cell algorithm
     Utold[:] = Ut[SN[:]]
     if np.any(np.isinf(Ut[SN[:]])) == True or np.any(np.isnan(Ut[SN[:]])) == True:
       print('Computational divergence')
       Ut[SN[:]] = np.nan_to_num(Ut[SN[:]])
-    tree = KDTree(Ut[SN[:]])
-    ind = tree.query_radius(Ut[SN[:]], r=0.5*a)  # Generates point-points proximity index arrays (ind) using the Kd-Tree algorithm (looks up the nearest neighbors of any point)
-    ind = [[indice for indice in ind[i] if indice != i] for i in range(len(ind))]  # Remove the index of the point itself
-    for i in range(nsn):
-      #ind[i] = [SN[ind[i][j]] for j in range(len(ind[i]))] # Find corresponding surface node index for "ind"
-      NNLt[i] = [np.where(SN[ind[i][tp]] == faces[:,:])[0] for tp in range(len(ind[i]))]  # Find corresponding proximity triangle indexes by the nearest neighbouring points indexes of a point
-      NNLt[i] = [item for sublist in NNLt[i] for item in sublist] # Merge all proximity triangle indexes for a point
-      NNLt[i] = list(set(NNLt[i]))  # Remove the same proximity triangle indexes for a point
-      NNLt[i] = [item for item in NNLt[i] if SN[i] != faces[item,0] and SN[i] != faces[item,1] and SN[i] != faces[item,2]] # Determine if the point is inside the proximity triangle or not
-  for i in range(nsn): # Loop through surface points
-    for tp in range(len(NNLt[i])): # Loop through corresponding proximity triangles
-      pt = SN[i]
-      tri = NNLt[i][tp] # A proximity triangle index
-      #if pt != faces[tri,0] and pt != faces[tri,1] and pt != faces[tri,2]:   # Determine if the point is inside the proximity triangle or not
-      pc, ubt, vbt, wbt = closestPointTriangle(Ut[pt], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)   # Find the closest point in the triangle to the point and barycentric coordinates of the triangle
-      cc = pc - Ut[pt]   # The closest point in the triangle subtracts to the point
-      rc = np.linalg.norm(cc)   # Distance between the closest point in the triangle to the point, sqrt(x*x+y*y+z*z)
-      if rc < hc and gr[pt] + gr[faces[tri,0]] > 0.0:  # Calculate contact force if within the contact range
-        cc *= 1.0/rc
-        Ntri = cross_dim_2(Ut[faces[tri,1]] - Ut[faces[tri,0]], Ut[faces[tri,2]] - Ut[faces[tri,0]]) # Triangle normal
-        Ntri *= 1.0/np.linalg.norm(Ntri)
-        fn = cc*(rc-hc)/hc*kc*a*a # kc = 10.0*K Contact stiffness
-        if np.dot(fn,Ntri) < 0.0:
-          fn -= Ntri*np.dot(fn,Ntri)*2.0
-        Ft[faces[tri,0]] -= fn*ubt
-        Ft[faces[tri,1]] -= fn*vbt
-        Ft[faces[tri,2]] -= fn*wbt
-        Ft[pt] += fn
+    NNLt = createNNLtriangleKDTree(Ut, SN, faces, nsn, 0.5*a, FN_ptr, FN_idx)  # Triangles incident to the nearest neighbouring points of a point, using the Kd-Tree algorithm
+    stats[0] += 1
+    stats[1] += nsn
+    stats[2] += time.time() - tic
+  NNLt = contactLists(NNLt, nf)
+  Ft = contactForces(Ut, Ft, SN, *NNLt, faces, FN_ptr, FN_idx, nsn, hc, kc, a, gr)
 
   return Ft, NNLt
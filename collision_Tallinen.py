@@ -1,6 +1,7 @@
-from mathfunc import closestPointTriangle, cross_dim_2, norm_dim_3
+from mathfunc import closestPointTriangle, closestPointTriangleBary, cross_dim_2, norm_dim_3
 import numpy as np
 import math
+import time
 from numba import jit, njit, prange
 
 # Generates point-triangle proximity lists (NNLt) using the linked cell algorithm
@@ -27,45 +28,331 @@ def createNNLtriangle(NNLt, Ut, faces, SN, nsn, nf, hs, bw, mw):
     ya = int((Ut[pt,1]+0.5*bw)/bw*mx)
     za = int((Ut[pt,2]+0.5*bw)/bw*mx)
 
-    for xi, yi, zi in zip(range(max(0,xa-1), min(mx-1, xa+1)+1), range(max(0,ya-1), min(mx-1, ya+1)+1), range(max(0,za-1), min(mx-1, za+1)+1)): # Browse head list
-      tri = head[mx*mx*zi + mx*yi + xi]
-      while tri != -1:
-        if pt != faces[tri,0] and pt != faces[tri,1] and pt != faces[tri,2]:
-          pc, ubt, vbt, wbt = closestPointTriangle(Ut[pt], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)
-          if np.linalg.norm(pc - Ut[pt]) < hs:
-            NNLt[i].append(tri)
-        tri = lists[tri]
+    for zi in range(max(0,za-1), min(mx-1, za+1)+1): # Browse head list of the 27 neighbouring cells
+      for yi in range(max(0,ya-1), min(mx-1, ya+1)+1):
+        for xi in range(max(0,xa-1), min(mx-1, xa+1)+1):
+          tri = head[mx*mx*zi + mx*yi + xi]
+          while tri != -1:
+            if pt != faces[tri,0] and pt != faces[tri,1] and pt != faces[tri,2]:
+              pc, ubt, vbt, wbt = closestPointTriangle(Ut[pt], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)
+              if np.linalg.norm(pc - Ut[pt]) < hs:
+                NNLt[i].append(tri)
+            tri = lists[tri]
 
   return NNLt
 
-# Calculate contact forces
+# Linked cell grid of surface triangles (binned by their centroid), sized from the bounding box of the surface
+# Returns the cell width (w), the grid origin (xmin, ymin, zmin), the number of cells per axis (mx, my, mz) and the head/next linked lists
+@njit
+def cellGridTriangle(Ut, faces, SN, nsn, nf, hs, mw):
+  xmin = ymin = zmin = np.inf
+  xmax = ymax = zmax = -np.inf
+  for i in range(nsn):
+    pt = SN[i]
+    xmin = min(xmin, Ut[pt,0])
+    ymin = min(ymin, Ut[pt,1])
+    zmin = min(zmin, Ut[pt,2])
+    xmax = max(xmax, Ut[pt,0])
+    ymax = max(ymax, Ut[pt,1])
+    zmax = max(zmax, Ut[pt,2])
+
+  # A point closer than hs to a triangle is at most hs + rmax from its centroid, so the 3x3x3 stencil is exhaustive if the cells are wider than that
+  rmax = 0.0
+  for i in range(nf):
+    cx = (Ut[faces[i,0],0] + Ut[faces[i,1],0] + Ut[faces[i,2],0])/3.0
+    cy = (Ut[faces[i,0],1] + Ut[faces[i,1],1] + Ut[faces[i,2],1])/3.0
+    cz = (Ut[faces[i,0],2] + Ut[faces[i,1],2] + Ut[faces[i,2],2])/3.0
+    for c in range(3):
+      dx = Ut[faces[i,c],0] - cx
+      dy = Ut[faces[i,c],1] - cy
+      dz = Ut[faces[i,c],2] - cz
+      rmax = max(rmax, dx*dx + dy*dy + dz*dz)
+  w = max(mw, hs + math.sqrt(rmax))
+
+  # Keep the grid at most a few cells per triangle
+  while ((xmax-xmin)/w + 1.0)*((ymax-ymin)/w + 1.0)*((zmax-zmin)/w + 1.0) > 8.0*nf + 64.0:
+    w *= 1.5
+  mx = int((xmax-xmin)/w) + 1
+  my = int((ymax-ymin)/w) + 1
+  mz = int((zmax-zmin)/w) + 1
+
+  head = np.full(mx*my*mz, -1, dtype=np.int64)
+  nxt = np.full(nf, -1, dtype=np.int64)
+  for i in range(nf):  # Divide triangle faces into cells, i index of face
+    cx = (Ut[faces[i,0],0] + Ut[faces[i,1],0] + Ut[faces[i,2],0])/3.0
+    cy = (Ut[faces[i,0],1] + Ut[faces[i,1],1] + Ut[faces[i,2],1])/3.0
+    cz = (Ut[faces[i,0],2] + Ut[faces[i,1],2] + Ut[faces[i,2],2])/3.0
+    xa = min(max(int((cx-xmin)/w), 0), mx-1)
+    ya = min(max(int((cy-ymin)/w), 0), my-1)
+    za = min(max(int((cz-zmin)/w), 0), mz-1)
+    cell = (za*my + ya)*mx + xa
+    nxt[i] = head[cell]
+    head[cell] = i
+
+  return w, xmin, ymin, zmin, mx, my, mz, head, nxt
+
+# Browse the 27 cells around surface node i and count (fill=False) or store (fill=True) its proximity triangles from position q of NNLt_idx
+@njit
+def cellNeighbourTriangles(Ut, faces, SN, i, hs, w, xmin, ymin, zmin, mx, my, mz, head, nxt, NNLt_idx, q, fill):
+  pt = SN[i]
+  xa = min(max(int((Ut[pt,0]-xmin)/w), 0), mx-1)
+  ya = min(max(int((Ut[pt,1]-ymin)/w), 0), my-1)
+  za = min(max(int((Ut[pt,2]-zmin)/w), 0), mz-1)
+  n = 0
+  for zi in range(max(0,za-1), min(mz-1,za+1)+1):
+    for yi in range(max(0,ya-1), min(my-1,ya+1)+1):
+      for xi in range(max(0,xa-1), min(mx-1,xa+1)+1):
+        tri = head[(zi*my + yi)*mx + xi]
+        while tri != -1:
+          f0 = faces[tri,0]
+          f1 = faces[tri,1]
+          f2 = faces[tri,2]
+          if pt != f0 and pt != f1 and pt != f2:
+            ub, vb, wb = closestPointTriangleBary(Ut, pt, f0, f1, f2)
+            dx = ub*Ut[f0,0] + vb*Ut[f1,0] + wb*Ut[f2,0] - Ut[pt,0]
+            dy = ub*Ut[f0,1] + vb*Ut[f1,1] + wb*Ut[f2,1] - Ut[pt,1]
+            dz = ub*Ut[f0,2] + vb*Ut[f1,2] + wb*Ut[f2,2] - Ut[pt,2]
+            if dx*dx + dy*dy + dz*dz < hs*hs:
+              if fill:
+                NNLt_idx[q+n] = tri
+              n += 1
+          tri = nxt[tri]
+
+  return n
+
+# Generates point-triangle proximity lists in compressed sparse row form (NNLt_ptr, NNLt_idx) using the linked cell algorithm, in nopython mode and in parallel over surface nodes
+@njit(parallel=True)
+def createNNLtriangleCells(Ut, faces, SN, nsn, nf, hs, mw):
+  w, xmin, ymin, zmin, mx, my, mz, head, nxt = cellGridTriangle(Ut, faces, SN, nsn, nf, hs, mw)
+
+  count = np.zeros(nsn, dtype=np.int64)
+  empty = np.zeros(0, dtype=np.int64)
+  for i in prange(nsn):
+    count[i] = cellNeighbourTriangles(Ut, faces, SN, i, hs, w, xmin, ymin, zmin, mx, my, mz, head, nxt, empty, 0, False)
+  NNLt_ptr = np.zeros(nsn+1, dtype=np.int64)
+  for i in range(nsn):
+    NNLt_ptr[i+1] = NNLt_ptr[i] + count[i]
+  NNLt_idx = np.zeros(NNLt_ptr[nsn], dtype=np.int64)
+  for i in prange(nsn):
+    cellNeighbourTriangles(Ut, faces, SN, i, hs, w, xmin, ymin, zmin, mx, my, mz, head, nxt, NNLt_idx, NNLt_ptr[i], True)
+
+  return NNLt_ptr, NNLt_idx
+
+# Partial refresh of the point-triangle proximity lists (NNLt_ptr, NNLt_idx): only surface nodes that moved more than skin since their list was built (Utold),
+# and nodes closer than hs to a triangle incident to such a node, get their lists recomputed (and their reference position Utold reset). A pair left out is then at least hs - 4*skin apart, so skin = 0.25*(hs-hc) misses no contact
+# Returns the new lists and the number of recomputed lists
+@njit(parallel=True)
+def refreshNNLtriangleCells(Ut, faces, SN, nsn, nf, hs, mw, Utold, skin, NNLt_ptr, NNLt_idx):
+  fast = np.zeros(nsn, dtype=np.bool_)
+  for i in prange(nsn):
+    pt = SN[i]
+    fast[i] = (Ut[pt,0]-Utold[i,0])**2 + (Ut[pt,1]-Utold[i,1])**2 + (Ut[pt,2]-Utold[i,2])**2 > skin*skin
+  if not np.any(fast):
+    return NNLt_ptr, NNLt_idx, 0
+
+  w, xmin, ymin, zmin, mx, my, mz, head, nxt = cellGridTriangle(Ut, faces, SN, nsn, nf, hs, mw)
+
+  # Triangles incident to fast nodes
+  fastg = np.zeros(Ut.shape[0], dtype=np.bool_)
+  for i in range(nsn):
+    fastg[SN[i]] = fast[i]
+  moved = np.zeros(nf, dtype=np.bool_)
+  for i in prange(nf):
+    moved[i] = fastg[faces[i,0]] or fastg[faces[i,1]] or fastg[faces[i,2]]
+
+  # Surface nodes in linked cells, then nodes closer than hs to a moved triangle (within the 27 cells around its centroid)
+  headn = np.full(mx*my*mz, -1, dtype=np.int64)
+  nxtn = np.full(nsn, -1, dtype=np.int64)
+  for i in range(nsn):
+    pt = SN[i]
+    xa = min(max(int((Ut[pt,0]-xmin)/w), 0), mx-1)
+    ya = min(max(int((Ut[pt,1]-ymin)/w), 0), my-1)
+    za = min(max(int((Ut[pt,2]-zmin)/w), 0), mz-1)
+    cell = (za*my + ya)*mx + xa
+    nxtn[i] = headn[cell]
+    headn[cell] = i
+  stale = fast.copy()
+  for tri in range(nf):
+    if not moved[tri]:
+      continue
+    f0 = faces[tri,0]
+    f1 = faces[tri,1]
+    f2 = faces[tri,2]
+    xa = min(max(int((Ut[f0,0]+Ut[f1,0]+Ut[f2,0])/3.0/w - xmin/w), 0), mx-1)
+    ya = min(max(int((Ut[f0,1]+Ut[f1,1]+Ut[f2,1])/3.0/w - ymin/w), 0), my-1)
+    za = min(max(int((Ut[f0,2]+Ut[f1,2]+Ut[f2,2])/3.0/w - zmin/w), 0), mz-1)
+    for zi in range(max(0,za-1), min(mz-1,za+1)+1):
+      for yi in range(max(0,ya-1), min(my-1,ya+1)+1):
+        for xi in range(max(0,xa-1), min(mx-1,xa+1)+1):
+          j = headn[(zi*my + yi)*mx + xi]
+          while j != -1:
+            pt = SN[j]
+            if not stale[j] and pt != f0 and pt != f1 and pt != f2:
+              ub, vb, wb = closestPointTriangleBary(Ut, pt, f0, f1, f2)
+              dx = ub*Ut[f0,0] + vb*Ut[f1,0] + wb*Ut[f2,0] - Ut[pt,0]
+              dy = ub*Ut[f0,1] + vb*Ut[f1,1] + wb*Ut[f2,1] - Ut[pt,1]
+              dz = ub*Ut[f0,2] + vb*Ut[f1,2] + wb*Ut[f2,2] - Ut[pt,2]
+              if dx*dx + dy*dy + dz*dz < hs*hs:
+                stale[j] = True
+            j = nxtn[j]
+
+  # Recompute the stale lists, keep the others
+  count = np.zeros(nsn, dtype=np.int64)
+  empty = np.zeros(0, dtype=np.int64)
+  for i in prange(nsn):
+    if stale[i]:
+      count[i] = cellNeighbourTriangles(Ut, faces, SN, i, hs, w, xmin, ymin, zmin, mx, my, mz, head, nxt, empty, 0, False)
+    else:
+      count[i] = NNLt_ptr[i+1] - NNLt_ptr[i]
+  ptr = np.zeros(nsn+1, dtype=np.int64)
+  for i in range(nsn):
+    ptr[i+1] = ptr[i] + count[i]
+  idx = np.zeros(ptr[nsn], dtype=np.int64)
+  nstale = 0
+  for i in prange(nsn):
+    if stale[i]:
+      cellNeighbourTriangles(Ut, faces, SN, i, hs, w, xmin, ymin, zmin, mx, my, mz, head, nxt, idx, ptr[i], True)
+      nstale += 1
+    else:
+      idx[ptr[i]:ptr[i+1]] = NNLt_idx[NNLt_ptr[i]:NNLt_ptr[i+1]]
+    if stale[i]:
+      Utold[i,0] = Ut[SN[i],0]
+      Utold[i,1] = Ut[SN[i],1]
+      Utold[i,2] = Ut[SN[i],2]
+
+  return ptr, idx, nstale
+
+# Convert point-triangle proximity lists (a list of lists) to compressed sparse row form: triangles of surface node i are NNLt_idx[NNLt_ptr[i]:NNLt_ptr[i+1]]
+def NNLtToCSR(lists, nsn):
+  NNLt_ptr = np.zeros(nsn+1, dtype=np.int64)
+  NNLt_ptr[1:] = np.cumsum([len(l) for l in lists])
+  NNLt_idx = np.zeros(NNLt_ptr[-1], dtype=np.int64)
+  for i in range(nsn):
+    NNLt_idx[NNLt_ptr[i]:NNLt_ptr[i+1]] = lists[i]
+
+  return NNLt_ptr, NNLt_idx
+
+# Contact workspace of proximity lists (NNLt_ptr, NNLt_idx): the pairs of each triangle in compressed sparse row form (TP_ptr, TP_idx, in increasing pair order)
+# and the per-pair force and barycentric buffers, allocated once per list and reused by contactForces
+@njit
+def contactWorkspace(NNLt_ptr, NNLt_idx, nf):
+  npairs = len(NNLt_idx)
+  TP_ptr = np.zeros(nf+1, dtype=np.int64)
+  for p in range(npairs):
+    TP_ptr[NNLt_idx[p]+1] += 1
+  for f in range(nf):
+    TP_ptr[f+1] += TP_ptr[f]
+  TP_idx = np.empty(npairs, dtype=np.int64)
+  fill = TP_ptr[:nf].copy()
+  for p in range(npairs):
+    TP_idx[fill[NNLt_idx[p]]] = p
+    fill[NNLt_idx[p]] += 1
+  fp = np.zeros((npairs,3), dtype=np.float64)  # Contact force of each pair on its surface node
+  bary = np.zeros((npairs,3), dtype=np.float64)  # Barycentric coordinates of the closest point in the triangle
+
+  return TP_ptr, TP_idx, fp, bary
+
+# Proximity lists with their contact workspace: NNLt as (NNLt_ptr, NNLt_idx, TP_ptr, TP_idx, fp, bary), the workspace being rebuilt only for new lists
+def contactLists(NNLt, nf, NNLt_ptr=None, NNLt_idx=None):
+  if NNLt_ptr is None:
+    NNLt_ptr, NNLt_idx = NNLt[0], NNLt[1]
+  if len(NNLt) == 6 and NNLt_ptr is NNLt[0] and NNLt_idx is NNLt[1]:
+    return NNLt
+
+  return (NNLt_ptr, NNLt_idx) + contactWorkspace(NNLt_ptr, NNLt_idx, nf)
+
+# Calculate contact forces for all point-triangle pairs of the proximity lists (NNLt_ptr, NNLt_idx), with the contact workspace of the lists (see contactWorkspace)
+# Pairs are evaluated in parallel, each surface node owning its own force. The reactions on triangle vertices are then gathered in parallel, each surface node summing
+# the reactions of the pairs of its incident triangles (node-triangle CSR FN_ptr, FN_idx, see vertexFacesCSR), so no two threads write the same node
+@njit(parallel=True)
+def contactForces(Ut, Ft, SN, NNLt_ptr, NNLt_idx, TP_ptr, TP_idx, fp, bary, faces, FN_ptr, FN_idx, nsn, hc, kc, a, gr):
+  for i in prange(nsn): # Loop through surface points
+    pt = SN[i]
+    fx = 0.0
+    fy = 0.0
+    fz = 0.0
+    for p in range(NNLt_ptr[i], NNLt_ptr[i+1]): # Loop through corresponding proximity triangles
+      tri = NNLt_idx[p]
+      f0 = faces[tri,0]
+      f1 = faces[tri,1]
+      f2 = faces[tri,2]
+      ub, vb, wb = closestPointTriangleBary(Ut, pt, f0, f1, f2)  # Closest point in the triangle to the point
+      ccx = ub*Ut[f0,0] + vb*Ut[f1,0] + wb*Ut[f2,0] - Ut[pt,0]
+      ccy = ub*Ut[f0,1] + vb*Ut[f1,1] + wb*Ut[f2,1] - Ut[pt,1]
+      ccz = ub*Ut[f0,2] + vb*Ut[f1,2] + wb*Ut[f2,2] - Ut[pt,2]
+      rc = math.sqrt(ccx*ccx + ccy*ccy + ccz*ccz)  # Distance between the closest point in the triangle to the point
+      fp[p,0] = 0.0
+      fp[p,1] = 0.0
+      fp[p,2] = 0.0
+      if rc < hc and gr[pt] + gr[f0] > 0.0:  # Calculate contact force if within the contact range
+        e1x = Ut[f1,0] - Ut[f0,0]
+        e1y = Ut[f1,1] - Ut[f0,1]
+        e1z = Ut[f1,2] - Ut[f0,2]
+        e2x = Ut[f2,0] - Ut[f0,0]
+        e2y = Ut[f2,1] - Ut[f0,1]
+        e2z = Ut[f2,2] - Ut[f0,2]
+        nx = e1y*e2z - e1z*e2y  # Triangle normal
+        ny = e1z*e2x - e1x*e2z
+        nz = e1x*e2y - e1y*e2x
+        nl = math.sqrt(nx*nx + ny*ny + nz*nz)
+        nx /= nl
+        ny /= nl
+        nz /= nl
+        s = (rc-hc)/hc*kc*a*a/rc # kc = 10.0*K Contact stiffness
+        fnx = ccx*s
+        fny = ccy*s
+        fnz = ccz*s
+        fnn = fnx*nx + fny*ny + fnz*nz
+        if fnn < 0.0:
+          fnx -= nx*fnn*2.0
+          fny -= ny*fnn*2.0
+          fnz -= nz*fnn*2.0
+        fp[p,0] = fnx
+        fp[p,1] = fny
+        fp[p,2] = fnz
+        bary[p,0] = ub
+        bary[p,1] = vb
+        bary[p,2] = wb
+        fx += fnx
+        fy += fny
+        fz += fnz
+    Ft[pt,0] += fx
+    Ft[pt,1] += fy
+    Ft[pt,2] += fz
+
+  for j in prange(nsn): # Gather the reactions on each surface node from the pairs of its incident triangles
+    pt = SN[j]
+    fx = 0.0
+    fy = 0.0
+    fz = 0.0
+    for k in range(FN_ptr[j], FN_ptr[j+1]):
+      tri = FN_idx[k]
+      c = 0
+      while faces[tri,c] != pt:
+        c += 1
+      for q in range(TP_ptr[tri], TP_ptr[tri+1]):
+        p = TP_idx[q]
+        fx += fp[p,0]*bary[p,c]
+        fy += fp[p,1]*bary[p,c]
+        fz += fp[p,2]*bary[p,c]
+    Ft[pt,0] -= fx
+    Ft[pt,1] -= fy
+    Ft[pt,2] -= fz
+
+  return Ft
+
+# Calculate contact forces, point-triangle proximity lists (NNLt) are kept in compressed sparse row form (NNLt_ptr, NNLt_idx) with their contact workspace (see contactLists)
+# The lists are refreshed node by node (see refreshNNLtriangleCells), the linked cell grid is sized from the bounding box of the surface, bw is not used anymore
+# stats: number of list updates, number of recomputed node lists and time spent in proximity detection, accumulated
 #@jit
-def contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr):
-  maxDist = 0.0
-  ub = vb = wb = 0.0  # Barycentric coordinates of triangles
-  maxDist = max(norm_dim_3(Ut[SN[:]] - Utold[:]))
-  if maxDist > 0.5*(hs-hc):
-    NNLt = createNNLtriangle(NNLt, Ut, faces, SN, nsn, nf, hs, bw, mw) # Generates point-triangle proximity lists (NNLt[nsn]) using the linked cell algorithm
-    for i in range(nsn):
-      Utold[i] = Ut[SN[i]]
-  for i in range(nsn): # Loop through surface points
-    for tp in range(len(NNLt[i])):
-      pt = SN[i] # A surface point index
-      tri = NNLt[i][tp] # A proximity triangle index
-      pc, ubt, vbt, wbt = closestPointTriangle(Ut[pt], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)  # Find the nearest point to Barycentric
-      cc = pc - Ut[pt] # moinus to all nodes
-      # closestPointTriangle returns the closest point of triangle abc to point p (returns a or b or c, if not, pt projection through the barycenter inside the triangle)
-      rc = np.linalg.norm(cc)   # Distance between the closest point in the triangle to the point, sqrt(x*x+y*y+z*z)
-      if rc < hc and gr[pt] + gr[faces[tri][0]] > 0.0:  # Calculate contact force if within the contact range
-        cc *= 1.0/rc
-        Ntri = cross_dim_2(Ut[faces[tri,1]] - Ut[faces[tri,0]], Ut[faces[tri,2]] - Ut[faces[tri,0]]) # Triangle normal
-        Ntri *= 1.0/np.linalg.norm(Ntri)
-        fn = cc*(rc-hc)/hc*kc*a*a # kc = 10.0*K Contact stiffness
-        if np.dot(fn,Ntri) < 0.0:
-          fn -= Ntri*np.dot(fn,Ntri)*2.0
-        Ft[faces[tri,0]] -= fn*ubt
-        Ft[faces[tri,1]] -= fn*vbt
-        Ft[faces[tri,2]] -= fn*wbt
-        Ft[pt] += fn
+def contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, stats):
+  tic = time.time()
+  NNLt_ptr, NNLt_idx, nstale = refreshNNLtriangleCells(Ut, faces, SN, nsn, nf, hs, mw, Utold, 0.25*(hs-hc), NNLt[0], NNLt[1]) # Point-triangle proximity lists (NNLt) using the linked cell algorithm
+  if nstale > 0:
+    stats[0] += 1
+    stats[1] += nstale
+    stats[2] += time.time() - tic
+  NNLt = contactLists(NNLt, nf, NNLt_ptr, NNLt_idx)
+  Ft = contactForces(Ut, Ft, SN, *NNLt, faces, FN_ptr, FN_idx, nsn, hc, kc, a, gr)
 
   return Ft, NNLt
@@ -34,14 +34,16 @@ def createNNLtriangle(NNLt, Ut, faces, SN, nsn, nf, hs, bw, mw):
   yya[:] = (Ut[SN[:],1] + 0.5*bw)/bw*mx
   zza[:] = (Ut[SN[:],2] + 0.5*bw)/bw*mx
   for i in range(nsn):
-    for xi, yi, zi in zip(range(max(0,xxa[i]-1), min(mx-1, xxa[i]+1)+1), range(max(0,yya[i]-1), min(mx-1, yya[i]+1)+1), range(max(0,zza[i]-1), min(mx-1, zza[i]+1)+1)): # Browse head list
-      tri = head[mx*mx*zi + mx*yi + xi]
-      while tri != -1:
-        if SN[i] != faces[tri,0] and SN[i] != faces[tri,1] and SN[i] != faces[tri,2]:
-          pc, ubt, vbt, wbt = closestPointTriangle(Ut[SN[i]], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)
-          if np.linalg.norm(pc - Ut[SN[i]]) < hs:
-            NNLt[i].append(tri)
-        tri = lists[tri]
+    for zi in range(max(0,zza[i]-1), min(mx-1, zza[i]+1)+1): # Browse head list of the 27 neighbouring cells
+      for yi in range(max(0,yya[i]-1), min(mx-1, yya[i]+1)+1):
+        for xi in range(max(0,xxa[i]-1), min(mx-1, xxa[i]+1)+1):
+          tri = head[mx*mx*zi + mx*yi + xi]
+          while tri != -1:
+            if SN[i] != faces[tri,0] and SN[i] != faces[tri,1] and SN[i] != faces[tri,2]:
+              pc, ubt, vbt, wbt = closestPointTriangle(Ut[SN[i]], Ut[faces[tri,0]], Ut[faces[tri,1]], Ut[faces[tri,2]], ub, vb, wb)
+              if np.linalg.norm(pc - Ut[SN[i]]) < hs:
+                NNLt[i].append(tri)
+            tri = lists[tri]
 		#NNLt[i] = NNLt[i,1:]
 	#NNLt = make_2D_array(NNLt)
 
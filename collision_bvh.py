@@ -0,0 +1,219 @@
+from mathfunc import closestPointTriangleBary, norm_dim_3
+from collision_Tallinen import contactForces, contactLists
+import numpy as np
+import math
+import time
+from numba import njit, prange
+
+# Bounding volume hierarchy (BVH) of surface triangles, stored in fixed-size arrays of 2*nf nodes:
+# lo, hi: corners of the axis-aligned node boxes, left, right: children (left = -1 for leaves), start, count: range of the node triangles in order,
+# info: number of nodes, surface area cost at the last full build, number of full builds
+# Children are always stored after their parent, so a backward sweep over the nodes refits the boxes bottom-up
+
+# Allocate and build the BVH of the surface triangles
+def createBVH(Ut, faces, nf, leaf=4):
+  lo = np.zeros((2*nf,3), dtype = np.float64)
+  hi = np.zeros((2*nf,3), dtype = np.float64)
+  left = np.full(2*nf, -1, dtype = np.int64)
+  right = np.full(2*nf, -1, dtype = np.int64)
+  start = np.zeros(2*nf, dtype = np.int64)
+  count = np.zeros(2*nf, dtype = np.int64)
+  order = np.arange(nf, dtype = np.int64)
+  info = np.zeros(3, dtype = np.float64)
+  BVH = (lo, hi, left, right, start, count, order, info)
+  rebuildBVH(Ut, faces, nf, BVH, leaf)
+
+  return BVH
+
+# Top-down build with median splits along the longest axis of the triangle centroids, then refit of the boxes
+def rebuildBVH(Ut, faces, nf, BVH, leaf=4):
+  lo, hi, left, right, start, count, order, info = BVH
+  info[0] = buildBVH(Ut, faces, nf, left, right, start, count, order, leaf)
+  info[1] = refitBVH(Ut, faces, int(info[0]), lo, hi, left, right, start, count, order)
+  info[2] += 1
+
+# Traversal stack with room for two more entries above sp: the stack is doubled when full, so deep trees (e.g. many triangles with equal centroids) cannot overflow it
+@njit
+def growStack(stack, sp):
+  if sp + 2 <= len(stack):
+    return stack
+  grown = np.zeros(2*len(stack), dtype = np.int64)
+  grown[:sp] = stack[:sp]
+
+  return grown
+
+@njit
+def buildBVH(Ut, faces, nf, left, right, start, count, order, leaf):
+  cen = np.zeros((nf,3), dtype = np.float64)
+  for i in range(nf):
+    order[i] = i
+    for j in range(3):
+      cen[i,j] = (Ut[faces[i,0],j] + Ut[faces[i,1],j] + Ut[faces[i,2],j])/3.0
+
+  stack = np.zeros(64, dtype = np.int64)
+  start[0] = 0
+  count[0] = nf
+  nnodes = 1
+  stack[0] = 0
+  sp = 1
+  while sp > 0:
+    sp -= 1
+    n = stack[sp]
+    s = start[n]
+    c = count[n]
+    left[n] = -1
+    right[n] = -1
+    if c <= leaf:
+      continue
+    # Longest axis of the centroid bounds
+    cmin = np.full(3, np.inf)
+    cmax = np.full(3, -np.inf)
+    for r in range(s, s+c):
+      for j in range(3):
+        cmin[j] = min(cmin[j], cen[order[r],j])
+        cmax[j] = max(cmax[j], cen[order[r],j])
+    axis = np.argmax(cmax - cmin)
+    sub = order[s:s+c].copy()
+    key = np.zeros(c, dtype = np.float64)
+    for r in range(c):
+      key[r] = cen[sub[r],axis]
+    order[s:s+c] = sub[np.argsort(key)]
+    h = c//2
+    l = nnodes
+    nnodes += 2
+    start[l] = s
+    count[l] = h
+    start[l+1] = s + h
+    count[l+1] = c - h
+    left[n] = l
+    right[n] = l + 1
+    stack = growStack(stack, sp)
+    stack[sp] = l + 1
+    stack[sp+1] = l
+    sp += 2
+
+  return nnodes
+
+# Refit the node boxes to the current positions, returns the surface area cost of the tree (sum of the node box areas relative to the root box area)
+@njit(parallel=True)
+def refitBVH(Ut, faces, nnodes, lo, hi, left, right, start, count, order):
+  for n in prange(nnodes):
+    if left[n] == -1:
+      for j in range(3):
+        lo[n,j] = np.inf
+        hi[n,j] = -np.inf
+      for r in range(start[n], start[n]+count[n]):
+        for c in range(3):
+          for j in range(3):
+            lo[n,j] = min(lo[n,j], Ut[faces[order[r],c],j])
+            hi[n,j] = max(hi[n,j], Ut[faces[order[r],c],j])
+  for n in range(nnodes-1, -1, -1):
+    if left[n] != -1:
+      for j in range(3):
+        lo[n,j] = min(lo[left[n],j], lo[right[n],j])
+        hi[n,j] = max(hi[left[n],j], hi[right[n],j])
+
+  cost = 0.0
+  for n in range(nnodes):
+    dx = hi[n,0] - lo[n,0]
+    dy = hi[n,1] - lo[n,1]
+    dz = hi[n,2] - lo[n,2]
+    cost += dx*dy + dy*dz + dz*dx
+
+  dx = hi[0,0] - lo[0,0]
+  dy = hi[0,1] - lo[0,1]
+  dz = hi[0,2] - lo[0,2]
+  return cost/max(dx*dy + dy*dz + dz*dx, 1e-30)
+
+# Traverse the BVH for surface node i and count (fill=False) or store (fill=True) its proximity triangles from position q of NNLt_idx
+@njit
+def bvhNeighbourTriangles(Ut, faces, SN, i, hs, lo, hi, left, right, start, count, order, NNLt_idx, q, fill):
+  pt = SN[i]
+  stack = np.zeros(64, dtype = np.int64)
+  sp = 1
+  n = 0
+  while sp > 0:
+    sp -= 1
+    nd = stack[sp]
+    # Squared distance from the point to the node box
+    d2 = 0.0
+    for j in range(3):
+      if Ut[pt,j] < lo[nd,j]:
+        d2 += (lo[nd,j] - Ut[pt,j])**2
+      elif Ut[pt,j] > hi[nd,j]:
+        d2 += (Ut[pt,j] - hi[nd,j])**2
+    if d2 >= hs*hs:
+      continue
+    if left[nd] != -1:
+      stack = growStack(stack, sp)
+      stack[sp] = right[nd]
+      stack[sp+1] = left[nd]
+      sp += 2
+      continue
+    for r in range(start[nd], start[nd]+count[nd]):
+      tri = order[r]
+      f0 = faces[tri,0]
+      f1 = faces[tri,1]
+      f2 = faces[tri,2]
+      if pt != f0 and pt != f1 and pt != f2:
+        ub, vb, wb = closestPointTriangleBary(Ut, pt, f0, f1, f2)
+        dx = ub*Ut[f0,0] + vb*Ut[f1,0] + wb*Ut[f2,0] - Ut[pt,0]
+        dy = ub*Ut[f0,1] + vb*Ut[f1,1] + wb*Ut[f2,1] - Ut[pt,1]
+        dz = ub*Ut[f0,2] + vb*Ut[f1,2] + wb*Ut[f2,2] - Ut[pt,2]
+        if dx*dx + dy*dy + dz*dz < hs*hs:
+          if fill:
+            NNLt_idx[q+n] = tri
+          n += 1
+
+  return n
+
+# Point-triangle proximity lists (NNLt_ptr, NNLt_idx) from BVH traversals, in parallel over surface nodes
+@njit(parallel=True)
+def queryBVH(Ut, faces, SN, nsn, hs, lo, hi, left, right, start, count, order):
+  cnt = np.zeros(nsn, dtype=np.int64)
+  empty = np.zeros(0, dtype=np.int64)
+  for i in prange(nsn):
+    cnt[i] = bvhNeighbourTriangles(Ut, faces, SN, i, hs, lo, hi, left, right, start, count, order, empty, 0, False)
+  NNLt_ptr = np.zeros(nsn+1, dtype=np.int64)
+  for i in range(nsn):
+    NNLt_ptr[i+1] = NNLt_ptr[i] + cnt[i]
+  NNLt_idx = np.zeros(NNLt_ptr[nsn], dtype=np.int64)
+  for i in prange(nsn):
+    bvhNeighbourTriangles(Ut, faces, SN, i, hs, lo, hi, left, right, start, count, order, NNLt_idx, NNLt_ptr[i], True)
+
+  return NNLt_ptr, NNLt_idx
+
+# Refit the boxes of the BVH to the current positions, and rebuild the tree when its surface area cost exceeds quality times the cost of the last build
+def updateBVH(Ut, faces, nf, BVH, quality=1.5):
+  lo, hi, left, right, start, count, order, info = BVH
+  cost = refitBVH(Ut, faces, int(info[0]), lo, hi, left, right, start, count, order)
+  if cost > quality*info[1]:
+    rebuildBVH(Ut, faces, nf, BVH)
+
+# Generates point-triangle proximity lists with the BVH, whose boxes fit the current positions (see updateBVH)
+def createNNLtriangleBVH(Ut, faces, SN, nsn, nf, hs, BVH):
+  lo, hi, left, right, start, count, order, info = BVH
+
+  return queryBVH(Ut, faces, SN, nsn, hs, lo, hi, left, right, start, count, order)
+
+# Calculate contact forces, point-triangle proximity lists (NNLt) are kept in compressed sparse row form (NNLt_ptr, NNLt_idx) with their contact workspace (see collision_Tallinen.contactLists)
+# FN_ptr, FN_idx: triangles incident to each surface node (see geometry.vertexFacesCSR), BVH: bounding volume hierarchy of the surface triangles (see createBVH), refitted at every call and, when needed, rebuilt in place
+# All the lists are rebuilt once a surface node moves more than 0.5*(hs-hc), node by node refreshes are only done by the linked cells (collision_Tallinen.contactProcess)
+# stats: number of list updates, number of recomputed node lists and time spent in proximity detection, accumulated
+def contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, BVH, stats, quality=1.5):
+  tic = time.time()
+  updateBVH(Ut, faces, nf, BVH, quality)
+  stats[2] += time.time() - tic
+  maxDist = 0.0
+  maxDist = max(norm_dim_3(Ut[SN[:]] - Utold[:]))
+  if maxDist > 0.5*(hs-hc):
+    tic = time.time()
+    NNLt = createNNLtriangleBVH(Ut, faces, SN, nsn, nf, hs, BVH) # Generates point-triangle proximity lists (NNLt) using the bounding volume hierarchy
+    stats[0] += 1
+    stats[1] += nsn
+    stats[2] += time.time() - tic
+    Utold[:] = Ut[SN[:]]
+  NNLt = contactLists(NNLt, nf)
+  Ft = contactForces(Ut, Ft, SN, *NNLt, faces, FN_ptr, FN_idx, nsn, hc, kc, a, gr)
+
+  return Ft, NNLt
@@ -1,5 +1,7 @@
 import numpy as np
 import math
+import os
+import itertools
 import numba
 from numba import jit, njit, prange
 from mathfunc import det_dim_3, det_dim_2, cross_dim_3, dot_mat_dim_3, transpose_dim_3, normalize_dim_3
@@ -24,6 +26,99 @@ def importMesh(path):
   #mesh = np.asarray(mesh, dtype=np.float64)
   return mesh
 
+# Read nrows lines of whitespace-separated numbers from an open mesh file, chunk by chunk, as a (nrows, ncols) array
+# Only the first ncols values of each line are kept, like importMesh. Lines with other widths or non-integer indices are parsed line by line, and a short line raises an error
+# naming the block (name) and its line in the file (the block starting at line start)
+def readMeshBlock(inputfile, nrows, ncols, dtype, name, start, chunk=65536):
+  p = 0
+  while p < nrows:
+    n = min(chunk, nrows - p)
+    lines = list(itertools.islice(inputfile, n))
+    if len(lines) < n:
+      raise ValueError('Malformed mesh file: the ' + name + ' block ends at line ' + str(start + p + len(lines)) + ', ' + str(nrows) + ' lines expected')
+    block = np.fromstring(''.join(lines), dtype=dtype, sep=' ')
+    width = len(lines[0].split())
+    if width >= ncols and block.size == n*width and len(lines[-1].split()) == width:
+      block = block.reshape(n, width)[:,:ncols]
+    else:
+      block = parseMeshLines(lines, ncols, dtype, name, start + p)
+    yield p, block
+    p += n
+
+# Parse lines of a mesh block one by one, keeping the first ncols values of each line (read as floats, as importMesh does)
+def parseMeshLines(lines, ncols, dtype, name, start):
+  block = np.zeros((len(lines), ncols), dtype=dtype)
+  for i, line in enumerate(lines):
+    values = line.split()
+    if len(values) < ncols:
+      raise ValueError('Malformed mesh file: line ' + str(start + i) + ' of the ' + name + ' block has ' + str(len(values)) + ' values, ' + str(ncols) + ' expected')
+    try:
+      block[i] = [float(x) for x in values[:ncols]]
+    except ValueError:
+      raise ValueError('Malformed mesh file: line ' + str(start + i) + ' of the ' + name + ' block is not numeric: ' + line.strip())
+
+  return block
+
+# Stream a .mesh file straight into preallocated node (Ut0), tetrahedron (tets) and triangle (faces) arrays
+# Same conventions as vertex, tetraVerticesIndices and triangleIndices: x and y are swapped, tets are made right handed and indices start at 0
+def importMeshStream(path, chunk=65536):
+  with open(path) as inputfile:
+    nn = int(inputfile.readline())
+    Ut0 = np.zeros((nn,3), dtype=np.float64)
+    for p, block in readMeshBlock(inputfile, nn, 3, np.float64, 'node', 2, chunk):
+      Ut0[p:p+len(block)] = block[:,[1,0,2]] # Change x, y (Netgen?)
+
+    ne = int(inputfile.readline())
+    tets = np.zeros((ne,4), dtype=np.int64)
+    for p, block in readMeshBlock(inputfile, ne, 5, np.int64, 'tetrahedron', nn + 3, chunk):
+      tets[p:p+len(block)] = block[:,[1,2,4,3]] - 1 # Note the switch of handedness (1,2,3,4 -> 1,2,4,3) - the code uses right handed tets
+
+    nf = int(inputfile.readline())
+    faces = np.zeros((nf,3), dtype=np.int64)
+    for p, block in readMeshBlock(inputfile, nf, 4, np.int64, 'triangle', nn + ne + 4, chunk):
+      faces[p:p+len(block)] = block[:,1:4] - 1
+
+  return Ut0, tets, faces
+
+# Paths of the binary sidecar files (.npy) of a .mesh file
+def binaryMeshPaths(path):
+  root = os.path.splitext(path)[0]
+
+  return root + '.nodes.npy', root + '.tets.npy', root + '.faces.npy'
+
+# Convert a .mesh file to binary sidecar files that can be memory-mapped by importMeshBinary
+def meshToBinary(path, Ut0=None, tets=None, faces=None):
+  if Ut0 is None:
+    Ut0, tets, faces = importMeshStream(path)
+  nodes_path, tets_path, faces_path = binaryMeshPaths(path)
+  np.save(nodes_path, Ut0)
+  np.save(tets_path, tets)
+  np.save(faces_path, faces)
+
+  return nodes_path, tets_path, faces_path
+
+# Load binary sidecar files; tets and faces stay memory-mapped, nodes are copied since they are normalized in place
+def importMeshBinary(path):
+  nodes_path, tets_path, faces_path = binaryMeshPaths(path)
+  Ut0 = np.array(np.load(nodes_path, mmap_mode='r'), dtype=np.float64)
+  tets = np.load(tets_path, mmap_mode='r')
+  faces = np.load(faces_path, mmap_mode='r')
+
+  return Ut0, tets, faces
+
+# Load a mesh, using (and optionally creating) up-to-date binary sidecar files, get undeformed and deformed coordinates, tets, faces and their numbers
+def loadMesh(path, binary=False):
+  sidecars = binaryMeshPaths(path)
+  if all(os.path.exists(p) for p in sidecars) and (not os.path.exists(path) or min(os.path.getmtime(p) for p in sidecars) >= os.path.getmtime(path)):
+    Ut0, tets, faces = importMeshBinary(path)
+  else:
+    Ut0, tets, faces = importMeshStream(path)
+    if binary:
+      meshToBinary(path, Ut0, tets, faces)
+  Ut = Ut0 # Initialize deformed coordinates of nodes
+
+  return Ut0, Ut, len(Ut0), tets, len(tets), faces, len(faces)
+
 # Read nodes, get undeformed coordinates x y z and save them in Ut0, initialize deformed coordinates Ut
 @njit(parallel=True)
 def vertex(mesh):
@@ -76,6 +171,44 @@ def numberSurfaceNodes(faces, nn, nf):
 
   return nsn, SN, SNb
 
+# Vertex-to-tetrahedron map in compressed sparse row form: the corners of node j are VT_idx[VT_ptr[j]:VT_ptr[j+1]], coded as 4*tet + local corner
+@njit
+def vertexTetraCSR(tets, nn):
+  ne = len(tets)
+  VT_ptr = np.zeros(nn+1, dtype=np.int64)
+  for i in range(ne):
+    for c in range(4):
+      VT_ptr[tets[i,c]+1] += 1
+  for j in range(nn):
+    VT_ptr[j+1] += VT_ptr[j]
+  fill = VT_ptr[:-1].copy()
+  VT_idx = np.zeros(4*ne, dtype=np.int64)
+  for i in range(ne):
+    for c in range(4):
+      VT_idx[fill[tets[i,c]]] = 4*i + c
+      fill[tets[i,c]] += 1
+
+  return VT_ptr, VT_idx
+
+# Surface node-to-triangle map in compressed sparse row form: the triangles incident to surface node i are FN_idx[FN_ptr[i]:FN_ptr[i+1]]
+@njit
+def vertexFacesCSR(faces, SNb, nsn):
+  nf = len(faces)
+  FN_ptr = np.zeros(nsn+1, dtype=np.int64)
+  for i in range(nf):
+    for c in range(3):
+      FN_ptr[SNb[faces[i,c]]+1] += 1
+  for j in range(nsn):
+    FN_ptr[j+1] += FN_ptr[j]
+  fill = FN_ptr[:-1].copy()
+  FN_idx = np.zeros(3*nf, dtype=np.int64)
+  for i in range(nf):
+    for c in range(3):
+      FN_idx[fill[SNb[faces[i,c]]]] = i
+      fill[SNb[faces[i,c]]] += 1
+
+  return FN_ptr, FN_idx
+
 # Check minimum, maximum and average edge lengths (average mesh spacing) at the surface
 @jit(nopython=True, parallel=True)
 def edge_length(Ut, faces, nf):
@@ -93,20 +226,17 @@ def edge_length(Ut, faces, nf):
 
   return mine, maxe, ave
 
-# Return the total volume of a tetrahedral mesh
-@jit(nopython=True, parallel=True)
-def volume_mesh(Vn_init, nn, ne, tets, Ut):
-  A_init = np.zeros((ne,3,3), dtype=np.float64)
+# Return the total volume of a tetrahedral mesh, nodal volumes (Vn_init) are gathered through the vertex-to-tetrahedron map (VT_ptr, VT_idx)
+@njit(parallel=True)
+def volume_mesh(Vn_init, nn, ne, tets, Ut, VT_ptr, VT_idx):
   vol_init = np.zeros(ne, dtype=np.float64)
-
-  A_init[:,0] = Ut[tets[:,1]] - Ut[tets[:,0]]
-  A_init[:,1] = Ut[tets[:,2]] - Ut[tets[:,0]]
-  A_init[:,2] = Ut[tets[:,3]] - Ut[tets[:,0]]
-  vol_init[:] = det_dim_3(transpose_dim_3(A_init[:]))/6.0
-
-  for i in range(ne):
-    #vol_init[i] = np.linalg.det(np.transpose(A_init[i]))/6.0
-    Vn_init[tets[i,:]] += vol_init[i]/4.0
+  for i in prange(ne):
+    vol_init[i] = tetraVolume(Ut, tets[i,0], tets[i,1], tets[i,2], tets[i,3])
+  for j in prange(nn):
+    v = 0.0
+    for p in range(VT_ptr[j], VT_ptr[j+1]):
+      v += vol_init[VT_idx[p]//4]
+    Vn_init[j] = v/4.0
 
   Vm_init = np.sum(Vn_init)
 
@@ -439,6 +569,89 @@ def configRefer(Ut0, tets, ne):
 
   return A0
 
+# Inverse (A0inv) and determinant (detA0) of the reference configuration of tetrahedra, computed once
+@njit(parallel=True)
+def configReferInverse(A0, ne):
+  A0inv = np.zeros((ne,3,3), dtype=np.float64)
+  detA0 = np.zeros(ne, dtype=np.float64)
+  for i in prange(ne):
+    c00 = A0[i,1,1]*A0[i,2,2] - A0[i,1,2]*A0[i,2,1]
+    c01 = A0[i,0,2]*A0[i,2,1] - A0[i,0,1]*A0[i,2,2]
+    c02 = A0[i,0,1]*A0[i,1,2] - A0[i,0,2]*A0[i,1,1]
+    c10 = A0[i,1,2]*A0[i,2,0] - A0[i,1,0]*A0[i,2,2]
+    c11 = A0[i,0,0]*A0[i,2,2] - A0[i,0,2]*A0[i,2,0]
+    c12 = A0[i,0,2]*A0[i,1,0] - A0[i,0,0]*A0[i,1,2]
+    c20 = A0[i,1,0]*A0[i,2,1] - A0[i,1,1]*A0[i,2,0]
+    c21 = A0[i,0,1]*A0[i,2,0] - A0[i,0,0]*A0[i,2,1]
+    c22 = A0[i,0,0]*A0[i,1,1] - A0[i,0,1]*A0[i,1,0]
+    det = A0[i,0,0]*c00 + A0[i,0,1]*c10 + A0[i,0,2]*c20
+    detA0[i] = det
+    A0inv[i,0,0] = c00/det
+    A0inv[i,0,1] = c01/det
+    A0inv[i,0,2] = c02/det
+    A0inv[i,1,0] = c10/det
+    A0inv[i,1,1] = c11/det
+    A0inv[i,1,2] = c12/det
+    A0inv[i,2,0] = c20/det
+    A0inv[i,2,1] = c21/det
+    A0inv[i,2,2] = c22/det
+
+  return A0inv, detA0
+
+# Relaxed (grown) state of tetrahedron i from its growth tensor g: inverse Arinv[i] = inv(g.A0) = A0inv.inv(g) and volume vol0[i] = det(g)*det(A0)/6
+@njit
+def referCacheTet(i, g00, g01, g02, g10, g11, g12, g20, g21, g22, A0inv, detA0, Arinv, vol0):
+  c00 = g11*g22 - g12*g21
+  c01 = g02*g21 - g01*g22
+  c02 = g01*g12 - g02*g11
+  c10 = g12*g20 - g10*g22
+  c11 = g00*g22 - g02*g20
+  c12 = g02*g10 - g00*g12
+  c20 = g10*g21 - g11*g20
+  c21 = g01*g20 - g00*g21
+  c22 = g00*g11 - g01*g10
+  detG = g00*c00 + g01*c10 + g02*c20
+  for p in range(3):
+    Arinv[i,p,0] = (A0inv[i,p,0]*c00 + A0inv[i,p,1]*c10 + A0inv[i,p,2]*c20)/detG
+    Arinv[i,p,1] = (A0inv[i,p,0]*c01 + A0inv[i,p,1]*c11 + A0inv[i,p,2]*c21)/detG
+    Arinv[i,p,2] = (A0inv[i,p,0]*c02 + A0inv[i,p,1]*c12 + A0inv[i,p,2]*c22)/detG
+  vol0[i] = detG*detA0[i]/6.0
+
+# Update the cache of the relaxed (grown) state of tetrahedra: inverse Arinv = inv(G.A0) = A0inv.inv(G) and volume vol0 = det(G)*det(A0)/6
+# Only tetrahedra whose growth tensor moved by more than tol since it was cached (Gc) are refreshed, e.g. non-growing regions are skipped
+@njit(parallel=True)
+def refreshReferCache(G, A0inv, detA0, Gc, Arinv, vol0, ne, tol):
+  refreshed = np.zeros(ne, dtype=np.int64)
+  for i in prange(ne):
+    change = 0.0
+    for p in range(3):
+      for q in range(3):
+        change = max(change, abs(G[i,p,q] - Gc[i,p,q]))
+    if change > tol:
+      referCacheTet(i, G[i,0,0], G[i,0,1], G[i,0,2], G[i,1,0], G[i,1,1], G[i,1,2], G[i,2,0], G[i,2,1], G[i,2,2], A0inv, detA0, Arinv, vol0)
+      for p in range(3):
+        for q in range(3):
+          Gc[i,p,q] = G[i,p,q]
+      refreshed[i] = 1
+
+  return Arinv, vol0, np.sum(refreshed)
+
+# Same as refreshReferCache for growth tensors in compact symmetric storage (Gs[:,0:6] = xx, yy, zz, xy, xz, yz, see growth.growthTensor_tangenSym)
+@njit(parallel=True)
+def refreshReferCacheSym(Gs, A0inv, detA0, Gc, Arinv, vol0, ne, tol):
+  refreshed = np.zeros(ne, dtype=np.int64)
+  for i in prange(ne):
+    change = 0.0
+    for p in range(6):
+      change = max(change, abs(Gs[i,p] - Gc[i,p]))
+    if change > tol:
+      referCacheTet(i, Gs[i,0], Gs[i,3], Gs[i,4], Gs[i,3], Gs[i,1], Gs[i,5], Gs[i,4], Gs[i,5], Gs[i,2], A0inv, detA0, Arinv, vol0)
+      for p in range(6):
+        Gc[i,p] = Gs[i,p]
+      refreshed[i] = 1
+
+  return Arinv, vol0, np.sum(refreshed)
+
 # Configuration of a deformed tetrahedron (At)
 @jit
 def configDeform(Ut, tets, ne):
@@ -475,6 +688,18 @@ def tetraNormals(N0, csn, tets, ne):
 
   return Nt
 
+# Calculate tangential projectors of tetrahedra (Pt = I - outer(Nt, Nt)), used by the tangential growth
+@njit(parallel=True)
+def tangentProjector(Nt, ne):
+  Pt = np.zeros((ne,3,3), dtype=np.float64)
+  for i in prange(ne):
+    for j in range(3):
+      for l in range(3):
+        Pt[i,j,l] = -Nt[i,j]*Nt[i,l]
+      Pt[i,j,j] += 1.0
+
+  return Pt
+
 # Calculate undeformed (Vn0) and deformed (Vn) nodal volume
 # Computes the volume measured at each point of a tetrahedral mesh as the sum of 1/4 of the volume of each of the tetrahedra to which it belongs
 @jit(nopython=True, parallel=True)   #(nopython=True, parallel=True)
@@ -498,6 +723,65 @@ def volumeNodal(G, A0, tets, Ut, ne, nn):
 
   return Vn0, Vn
 
+# Signed volume of the tetrahedron (t0, t1, t2, t3), det(At)/6
+@njit
+def tetraVolume(Ut, t0, t1, t2, t3):
+  x1 = Ut[t1,0] - Ut[t0,0]
+  y1 = Ut[t1,1] - Ut[t0,1]
+  z1 = Ut[t1,2] - Ut[t0,2]
+  x2 = Ut[t2,0] - Ut[t0,0]
+  y2 = Ut[t2,1] - Ut[t0,1]
+  z2 = Ut[t2,2] - Ut[t0,2]
+  x3 = Ut[t3,0] - Ut[t0,0]
+  y3 = Ut[t3,1] - Ut[t0,1]
+  z3 = Ut[t3,2] - Ut[t0,2]
+
+  return (x1*(y2*z3 - z2*y3) - y1*(x2*z3 - z2*x3) + z1*(x2*y3 - y2*x3))/6.0
+
+# Smallest altitude of the deformed tetrahedra, 3*|vol|/(largest face area), used for the stable time step
+@njit(parallel=True)
+def minAltitude(Ut, tets, ne):
+  hmin = np.inf
+  for i in prange(ne):
+    vol = abs(tetraVolume(Ut, tets[i,0], tets[i,1], tets[i,2], tets[i,3]))
+    amax = 0.0
+    for f in range(4):
+      p0 = tets[i,f]
+      p1 = tets[i,(f+1)%4]
+      p2 = tets[i,(f+2)%4]
+      ex = Ut[p1,0] - Ut[p0,0]
+      ey = Ut[p1,1] - Ut[p0,1]
+      ez = Ut[p1,2] - Ut[p0,2]
+      gx = Ut[p2,0] - Ut[p0,0]
+      gy = Ut[p2,1] - Ut[p0,1]
+      gz = Ut[p2,2] - Ut[p0,2]
+      nx = ey*gz - ez*gy
+      ny = ez*gx - ex*gz
+      nz = ex*gy - ey*gx
+      amax = max(amax, 0.5*math.sqrt(nx*nx + ny*ny + nz*nz))
+    hmin = min(hmin, 3.0*vol/amax)
+
+  return hmin
+
+# Calculate undeformed (Vn0) and deformed (Vn) nodal volumes in parallel and without write conflicts
+# Volumes of tetrahedra are computed once into vol, then gathered to nodes through the vertex-to-tetrahedron map (VT_ptr, VT_idx)
+@njit(parallel=True)
+def volumeNodalGather(vol0, tets, Ut, ne, nn, VT_ptr, VT_idx, vol):
+  for i in prange(ne):
+    vol[i] = tetraVolume(Ut, tets[i,0], tets[i,1], tets[i,2], tets[i,3])
+  Vn0 = np.zeros(nn, dtype=np.float64) #Initialize nodal volumes in reference state
+  Vn = np.zeros(nn, dtype=np.float64)  #Initialize deformed nodal volumes
+  for j in prange(nn):
+    v0 = 0.0
+    v = 0.0
+    for p in range(VT_ptr[j], VT_ptr[j+1]):
+      v0 += vol0[VT_idx[p]//4]
+      v += vol[VT_idx[p]//4]
+    Vn0[j] = v0/4.0
+    Vn[j] = v/4.0
+
+  return Vn0, Vn
+
 # Midplane
 @njit(parallel=True)
 def midPlane(Ut, Ut0, Ft, SN, nsn, mpy, a, hc, K):
@@ -99,25 +99,45 @@ def shearModulus(d2s, H, tets, ne, muw, mug, gr):
 
   return gm, mu
 
-# Calculate relative (relates to d2s) tangential growth factor G
-@jit
+# Calculate relative (relates to d2s) tangential growth factor G = I + (I - outer(Nt, Nt))*gm*at, in place
+@njit(parallel=True)
 def growthTensor_tangen(Nt, gm, at, G, ne):
-  A = np.zeros((ne,3,3), dtype=np.float64)
-  A[:,0,0] = Nt[:,0]*Nt[:,0]
-  A[:,0,1] = Nt[:,0]*Nt[:,1]
-  A[:,0,2] = Nt[:,0]*Nt[:,2]
-  A[:,1,0] = Nt[:,0]*Nt[:,1]
-  A[:,1,1] = Nt[:,1]*Nt[:,1]
-  A[:,1,2] = Nt[:,1]*Nt[:,2]
-  A[:,2,0] = Nt[:,0]*Nt[:,2]
-  A[:,2,1] = Nt[:,1]*Nt[:,2]
-  A[:,2,2] = Nt[:,2]*Nt[:,2]
   for i in prange(ne):
-    G[i] = np.identity(3) + (np.identity(3) - A[i])*gm[i]*at[i]
+    s = gm[i]*at[i]
+    for j in range(3):
+      for l in range(3):
+        G[i,j,l] = -Nt[i,j]*Nt[i,l]*s
+      G[i,j,j] += 1.0 + s
   #G[i] = np.identity(3) + (np.identity(3) - np.matrix([[Nt[0]*Nt[0], Nt[0]*Nt[1], Nt[0]*Nt[2]], [Nt[0]*Nt[1], Nt[1]*Nt[1], Nt[1]*Nt[2]], [Nt[0]*Nt[2], Nt[1]*Nt[2], Nt[2]*Nt[2]]]))*gm*at
 
   return G
 
+# Calculate relative tangential growth factor G in place, in compact symmetric storage (Gs[:,0:6] = xx, yy, zz, xy, xz, yz)
+@njit(parallel=True)
+def growthTensor_tangenSym(Nt, gm, at, Gs, ne):
+  for i in prange(ne):
+    s = gm[i]*at[i]
+    Gs[i,0] = 1.0 + (1.0 - Nt[i,0]*Nt[i,0])*s
+    Gs[i,1] = 1.0 + (1.0 - Nt[i,1]*Nt[i,1])*s
+    Gs[i,2] = 1.0 + (1.0 - Nt[i,2]*Nt[i,2])*s
+    Gs[i,3] = -Nt[i,0]*Nt[i,1]*s
+    Gs[i,4] = -Nt[i,0]*Nt[i,2]*s
+    Gs[i,5] = -Nt[i,1]*Nt[i,2]*s
+
+  return Gs
+
+# Calculate relative tangential growth factor G in place from precomputed tangential projectors (Pt = I - outer(Nt, Nt), see geometry.tangentProjector)
+@njit(parallel=True)
+def growthTensor_tangenProj(Pt, gm, at, G, ne):
+  for i in prange(ne):
+    s = gm[i]*at[i]
+    for j in range(3):
+      for l in range(3):
+        G[i,j,l] = Pt[i,j,l]*s
+      G[i,j,j] += 1.0
+
+  return G
+
 # Calculate homogeneous growth factor G
 @jit
 def growthTensor_homo(G, ne, GROWTH_RELATIVE, t):
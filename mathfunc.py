@@ -62,6 +62,61 @@ def closestPointTriangle(p, a, b, c, u, v, w):
 
   return a + ab * v + ac * w, u, v, w
 
+# Barycentric coordinates (u, v, w) of the closest point of triangle (a, b, c) to point p, nodes given by their indices in Ut
+# Scalar version of closestPointTriangle for nopython kernels, the closest point is u*Ut[a] + v*Ut[b] + w*Ut[c]
+@njit
+def closestPointTriangleBary(Ut, p, a, b, c):
+  abx = Ut[b,0] - Ut[a,0]
+  aby = Ut[b,1] - Ut[a,1]
+  abz = Ut[b,2] - Ut[a,2]
+  acx = Ut[c,0] - Ut[a,0]
+  acy = Ut[c,1] - Ut[a,1]
+  acz = Ut[c,2] - Ut[a,2]
+  apx = Ut[p,0] - Ut[a,0]
+  apy = Ut[p,1] - Ut[a,1]
+  apz = Ut[p,2] - Ut[a,2]
+  d1 = abx*apx + aby*apy + abz*apz
+  d2 = acx*apx + acy*apy + acz*apz
+  if d1 <= 0.0 and d2 <= 0.0:
+    return 1.0, 0.0, 0.0
+
+  bpx = Ut[p,0] - Ut[b,0]
+  bpy = Ut[p,1] - Ut[b,1]
+  bpz = Ut[p,2] - Ut[b,2]
+  d3 = abx*bpx + aby*bpy + abz*bpz
+  d4 = acx*bpx + acy*bpy + acz*bpz
+  if d3 >= 0.0 and d4 <= d3:
+    return 0.0, 1.0, 0.0
+
+  vc = d1*d4 - d3*d2
+  if vc <= 0.0 and d1 >= 0.0 and d3 <= 0.0:
+    v = d1 / (d1 - d3)
+    return 1.0 - v, v, 0.0
+
+  cpx = Ut[p,0] - Ut[c,0]
+  cpy = Ut[p,1] - Ut[c,1]
+  cpz = Ut[p,2] - Ut[c,2]
+  d5 = abx*cpx + aby*cpy + abz*cpz
+  d6 = acx*cpx + acy*cpy + acz*cpz
+  if d6 >= 0.0 and d5 <= d6:
+    return 0.0, 0.0, 1.0
+
+  vb = d5*d2 - d1*d6
+  if vb <= 0.0 and d2 >= 0.0 and d6 <= 0.0:
+    w = d2 / (d2 - d6)
+    return 1.0 - w, 0.0, w
+
+  va = d3*d6 - d5*d4
+  if va <= 0.0 and (d4 - d3) >= 0.0 and (d5 - d6) >= 0.0:
+    w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+    return 0.0, 1.0 - w, w
+
+  denom = 1.0 / (va + vb + vc)
+  v = vb * denom
+  w = vc * denom
+
+  return 1.0 - v - w, v, w
+
 @jit
 def EV(X):
   c1 = X[0,0]*X[1,1] + X[0,0]*X[2,2] + X[1,1]*X[2,2] - X[0,1]*X[0,1] - X[1,2]*X[1,2] - X[0,2]*X[0,2]
@@ -1,5 +1,6 @@
 from __future__ import division
 from mathfunc import det_dim_2, det_dim_3, inv, inv_dim_3, cross_dim_2, transpose_dim_3, dot_mat_dim_3, EV, Eigensystem, dot_const_mat_dim_3
+from geometry import volumeNodalGather
 import numpy as np
 import math
 from math import sqrt
@@ -127,6 +128,244 @@ def tetraElasticity(At, A0, Ft, G, K, k, mu, tets, Vn, Vn0, ne, eps):
 
   return Ft
 
+# First Piola-Kirchhoff stress of a tetrahedron whose deformation gradient F is badly conditioned or inverted (SVD branch of tetraElasticity)
+@njit
+def tetraStressSVD(F, mu, Ja, K, k, eps):
+  C = np.dot(F.transpose(), F)
+
+  V = np.identity(3)
+  eva = [0.0]*3
+  w2, v2 = Eigensystem(3, C, V, eva)
+
+  l1 = sqrt(w2[0])
+  l2 = sqrt(w2[1])
+  l3 = sqrt(w2[2])
+
+  if det_dim_2(v2) < 0.0:
+    v2[0,0] = -v2[0,0]
+    v2[1,0] = -v2[1,0]
+    v2[2,0] = -v2[2,0]
+
+  Fdi = np.identity(3)
+  if l1 >= 1e-25:
+    Fdi[0,0] = 1.0/l1
+    Fdi[1,1] = 1.0/l2
+    Fdi[2,2] = 1.0/l3
+
+  U = np.dot(F, np.dot(v2, Fdi))
+
+  if l1 < 1e-25:
+    U[0,0] = U[1,1]*U[2,2] - U[2,1]*U[1,2]
+    U[1,0] = U[2,1]*U[0,2] - U[0,1]*U[2,2]
+    U[2,0] = U[0,1]*U[1,2] - U[1,1]*U[0,2]
+
+  if det_dim_2(F) < 0.0:
+    l1 = -l1
+    U[0,0] = -U[0,0]
+    U[1,0] = -U[1,0]
+    U[2,0] = -U[2,0]
+
+  Pd = np.identity(3)
+  pow23 = np.power(eps*l2*l3, 2.0/3.0)
+  Pd[0,0] = mu/3.0*(2.0*eps - l2*l2/eps - l3*l3/eps)/pow23 + k*(l1-eps) + K*(Ja-1.0)*l2*l3
+  Pd[1,1] = mu/3.0*(-eps*eps/l2 + 2.0*l2 - l3*l3/l2)/pow23 + mu/9.0*(-4.0*eps/l2 - 4.0/eps*l2 + 2.0/eps/l2*l3*l3)/pow23*(l1-eps) + K*(Ja-1.0)*l1*l3
+  Pd[2,2] = mu/3.0*(-eps*eps/l3 - l2*l2/l3 + 2.0*l3)/pow23 + mu/9.0*(-4.0*eps/l3 + 2.0/eps*l2*l2/l3 - 4.0/eps*l3)/pow23*(l1-eps) + K*(Ja-1.0)*l1*l2
+
+  return np.dot(U, np.dot(Pd, v2.transpose()))
+
+# Eigenvalues of a symmetric 3x3 matrix given by its 6 upper components (scalar version of EV)
+@njit
+def EV_sym(x00, x01, x02, x11, x12, x22):
+  tr = x00 + x11 + x22
+  c1 = x00*x11 + x00*x22 + x11*x22 - x01*x01 - x12*x12 - x02*x02
+  c0 = x22*x01*x01 + x00*x12*x12 + x11*x02*x02 - x00*x11*x22 - 2.0*x02*x01*x12
+  p = tr*tr - 3.0*c1
+  q = tr*(p - 3.0/2.0*c1) - 27.0/2.0*c0
+
+  phi = 27.0 * (0.25*c1*c1*(p-c1) + c0*(q + 27.0/4.0*c0))
+  phi = 1.0/3.0 * math.atan2(sqrt(math.fabs(phi)), q)
+  t = sqrt(math.fabs(p)) * math.cos(phi)
+  s = 1.0/sqrt(3.0) * sqrt(math.fabs(p)) * math.sin(phi)
+
+  l3 = 1.0/3.0 * (tr - t) - s
+  l2 = l3 + 2.0 * s
+  l1 = l3 + t + s
+
+  return l1, l2, l3
+
+# Calculate elastic forces at the four corners of each tetrahedron (Fe[4*i+c]) in a single pass, from nodal positions (Ut) and the cached relaxed state (Arinv, vol0)
+# Same model as tetraElasticity, but all 3x3 algebra is done on scalars so no (ne,3,3) temporaries are allocated
+# If deformed volumes of tetrahedra (vol) are given, the relative volume change is taken as vol/vol0 instead of det(F)
+@njit(parallel=True)
+def tetraForces(Ut, tets, Arinv, vol0, Fe, K, k, mu, Vn, Vn0, ne, eps, vol):
+  for i in prange(ne):
+    t0 = tets[i,0]
+    t1 = tets[i,1]
+    t2 = tets[i,2]
+    t3 = tets[i,3]
+
+    # Deformed configuration (At), columns are edges from the first vertex
+    a00 = Ut[t1,0] - Ut[t0,0]
+    a10 = Ut[t1,1] - Ut[t0,1]
+    a20 = Ut[t1,2] - Ut[t0,2]
+    a01 = Ut[t2,0] - Ut[t0,0]
+    a11 = Ut[t2,1] - Ut[t0,1]
+    a21 = Ut[t2,2] - Ut[t0,2]
+    a02 = Ut[t3,0] - Ut[t0,0]
+    a12 = Ut[t3,1] - Ut[t0,1]
+    a22 = Ut[t3,2] - Ut[t0,2]
+
+    # Inverse of the relaxed (grown) state, cached by refreshReferCache
+    c00 = Arinv[i,0,0]
+    c01 = Arinv[i,0,1]
+    c02 = Arinv[i,0,2]
+    c10 = Arinv[i,1,0]
+    c11 = Arinv[i,1,1]
+    c12 = Arinv[i,1,2]
+    c20 = Arinv[i,2,0]
+    c21 = Arinv[i,2,1]
+    c22 = Arinv[i,2,2]
+
+    # Deformation gradient F = At.inv(Ar)
+    f00 = a00*c00 + a01*c10 + a02*c20
+    f01 = a00*c01 + a01*c11 + a02*c21
+    f02 = a00*c02 + a01*c12 + a02*c22
+    f10 = a10*c00 + a11*c10 + a12*c20
+    f11 = a10*c01 + a11*c11 + a12*c21
+    f12 = a10*c02 + a11*c12 + a12*c22
+    f20 = a20*c00 + a21*c10 + a22*c20
+    f21 = a20*c01 + a21*c11 + a22*c21
+    f22 = a20*c02 + a21*c12 + a22*c22
+
+    # Left Cauchy-Green strain tensor B = F.F^T (symmetric)
+    b00 = f00*f00 + f01*f01 + f02*f02
+    b01 = f00*f10 + f01*f11 + f02*f12
+    b02 = f00*f20 + f01*f21 + f02*f22
+    b11 = f10*f10 + f11*f11 + f12*f12
+    b12 = f10*f20 + f11*f21 + f12*f22
+    b22 = f20*f20 + f21*f21 + f22*f22
+
+    # Cofactor matrix of F, relative volume change and averaged nodal volume change
+    g00 = f11*f22 - f12*f21
+    g01 = f12*f20 - f10*f22
+    g02 = f10*f21 - f11*f20
+    g10 = f02*f21 - f01*f22
+    g11 = f00*f22 - f02*f20
+    g12 = f01*f20 - f00*f21
+    g20 = f01*f12 - f02*f11
+    g21 = f02*f10 - f00*f12
+    g22 = f00*f11 - f01*f10
+    if len(vol) > 0:
+      J = vol[i]/vol0[i]
+    else:
+      J = f00*g00 + f01*g01 + f02*g02
+    Ja = (Vn[t0]/Vn0[t0] + Vn[t1]/Vn0[t1] + Vn[t2]/Vn0[t2] + Vn[t3]/Vn0[t3])/4.0
+
+    ll1, ll2, ll3 = EV_sym(b00, b01, b02, b11, b12, b22)
+
+    if ll3 >= eps**2 and J > 0.0: # No need for SVD
+
+      # Total stress (shear stress + bulk stress) S, and P = S.inv(F^T)*J = S.cof(F)
+      powJ23 = np.power(J, 2.0/3.0)
+      trB3 = (b00 + b11 + b22)/3.0
+      sm = mu[i]/(J*powJ23)
+      sb = K*(Ja-1.0)
+      s00 = (b00 - trB3)*sm + sb
+      s01 = b01*sm
+      s02 = b02*sm
+      s11 = (b11 - trB3)*sm + sb
+      s12 = b12*sm
+      s22 = (b22 - trB3)*sm + sb
+      p00 = s00*g00 + s01*g10 + s02*g20
+      p01 = s00*g01 + s01*g11 + s02*g21
+      p02 = s00*g02 + s01*g12 + s02*g22
+      p10 = s01*g00 + s11*g10 + s12*g20
+      p11 = s01*g01 + s11*g11 + s12*g21
+      p12 = s01*g02 + s11*g12 + s12*g22
+      p20 = s02*g00 + s12*g10 + s22*g20
+      p21 = s02*g01 + s12*g11 + s22*g21
+      p22 = s02*g02 + s12*g12 + s22*g22
+
+    else:  # Needs SVD, always in float64 whatever the storage precision (np.dot in tetraStressSVD needs operands of the same type)
+      F = np.array([[f00, f01, f02], [f10, f11, f12], [f20, f21, f22]], dtype=np.float64)
+      P = tetraStressSVD(F, mu[i], Ja, K, k, eps)
+      p00 = P[0,0]
+      p01 = P[0,1]
+      p02 = P[0,2]
+      p10 = P[1,0]
+      p11 = P[1,1]
+      p12 = P[1,2]
+      p20 = P[2,0]
+      p21 = P[2,1]
+      p22 = P[2,2]
+
+    # Tetra face negative normals (because traction Ft=-P*n), from the columns xr1, xr2, xr3 of Ar
+    # They are the columns of the cofactor matrix det(Ar)*inv(Ar)^T, with det(Ar) = 6*vol0
+    d = 6.0*vol0[i]
+    n2x = d*c00  # N2 = xr2 x xr3
+    n2y = d*c01
+    n2z = d*c02
+    n1x = d*c10  # N1 = xr3 x xr1
+    n1y = d*c11
+    n1z = d*c12
+    n3x = d*c20  # N3 = xr1 x xr2
+    n3y = d*c21
+    n3z = d*c22
+    n4x = -(n1x + n2x + n3x)  # N4 = (xr2-xr3) x (xr1-xr3)
+    n4y = -(n1y + n2y + n3y)
+    n4z = -(n1z + n2z + n3z)
+
+    # Forces at tetra vertices: Ft[t0] += P.(N1+N2+N3)/6 = -P.N4/6, and similarly for the other vertices
+    Fe[4*i,0] = -(p00*n4x + p01*n4y + p02*n4z)/6.0
+    Fe[4*i,1] = -(p10*n4x + p11*n4y + p12*n4z)/6.0
+    Fe[4*i,2] = -(p20*n4x + p21*n4y + p22*n4z)/6.0
+    Fe[4*i+1,0] = -(p00*n2x + p01*n2y + p02*n2z)/6.0
+    Fe[4*i+1,1] = -(p10*n2x + p11*n2y + p12*n2z)/6.0
+    Fe[4*i+1,2] = -(p20*n2x + p21*n2y + p22*n2z)/6.0
+    Fe[4*i+2,0] = -(p00*n1x + p01*n1y + p02*n1z)/6.0
+    Fe[4*i+2,1] = -(p10*n1x + p11*n1y + p12*n1z)/6.0
+    Fe[4*i+2,2] = -(p20*n1x + p21*n1y + p22*n1z)/6.0
+    Fe[4*i+3,0] = -(p00*n3x + p01*n3y + p02*n3z)/6.0
+    Fe[4*i+3,1] = -(p10*n3x + p11*n3y + p12*n3z)/6.0
+    Fe[4*i+3,2] = -(p20*n3x + p21*n3y + p22*n3z)/6.0
+
+  return Fe
+
+# Gather tetrahedron corner forces (Fe) to nodes through the vertex-to-tetrahedron map (VT_ptr, VT_idx)
+# Each node is owned by a single thread and sums its corners in a fixed order, so the result is race free and independent of the number of threads
+@njit(parallel=True)
+def gatherForces(Fe, Ft, VT_ptr, VT_idx, nn):
+  for j in prange(nn):
+    fx = 0.0
+    fy = 0.0
+    fz = 0.0
+    for p in range(VT_ptr[j], VT_ptr[j+1]):
+      fx += Fe[VT_idx[p],0]
+      fy += Fe[VT_idx[p],1]
+      fz += Fe[VT_idx[p],2]
+    Ft[j,0] += fx
+    Ft[j,1] += fy
+    Ft[j,2] += fz
+
+  return Ft
+
+# Calculate elastic forces: fused per-tetrahedron pass into the corner force buffer (Fe, shape (4*ne,3)), then deterministic gather to nodes
+@njit
+def tetraElasticityFused(Ut, tets, Arinv, vol0, Ft, K, k, mu, Vn, Vn0, ne, eps, Fe, VT_ptr, VT_idx):
+  Fe = tetraForces(Ut, tets, Arinv, vol0, Fe, K, k, mu, Vn, Vn0, ne, eps, np.zeros(0, dtype=np.float64))
+  Ft = gatherForces(Fe, Ft, VT_ptr, VT_idx, len(Ft))
+
+  return Ft
+
+# Calculate nodal volumes and elastic forces together: volumes of tetrahedra (vol) are computed once and reused for the nodal volumes (Vn0, Vn) and the volume changes (J, Ja)
+@njit
+def tetraElasticityVolume(Ut, tets, Arinv, vol0, Ft, K, k, mu, ne, eps, Fe, VT_ptr, VT_idx, vol):
+  Vn0, Vn = volumeNodalGather(vol0, tets, Ut, ne, len(Ft), VT_ptr, VT_idx, vol)
+  Fe = tetraForces(Ut, tets, Arinv, vol0, Fe, K, k, mu, Vn, Vn0, ne, eps, vol)
+  Ft = gatherForces(Fe, Ft, VT_ptr, VT_idx, len(Ft))
+
+  return Ft, Vn0, Vn
+
 # Newton dynamics (Integrate velocity into displacement)
 @njit(parallel=True)
 def move(nn, Ft, Vt, Ut, gamma, Vn0, rho, dt):
@@ -137,3 +376,63 @@ def move(nn, Ft, Vt, Ut, gamma, Vn0, rho, dt):
   Ft[:] = np.zeros((nn,3), dtype = np.float64)
 
   return Ft, Ut, Vt
+
+# Estimate of the largest stable time step of explicit dynamics: the elastic wave crossing time of the thinnest element (hmin, largest shear modulus mumax, bulk modulus K),
+# and the period of the contact spring (stiffness kc*a*a/hc) on the lightest surface node (mass mmin)
+def stableTimeStep(hmin, mumax, K, kc, a, hc, rho, mmin):
+  dte = hmin*math.sqrt(rho/(K + 4.0/3.0*mumax))
+  dtc = math.sqrt(mmin*hc/(kc*a*a))
+
+  return min(dte, dtc)
+
+# Fused Newton dynamics integrators: damping, velocity and position updates and reset of the force buffer in a single parallel pass, without allocations
+# They share the signature (nn, Ft, Vt, Ut, Ab, gamma, Vn0, rho, dt, first), with Ab the accelerations of the previous step (velocity Verlet only) and first True at the first time step
+# The damping force -gamma*Vn0*Vt over the nodal mass rho*Vn0 gives the damping rate c = gamma/rho
+
+# Semi-implicit Euler, same scheme as move
+@njit(parallel=True)
+def moveEuler(nn, Ft, Vt, Ut, Ab, gamma, Vn0, rho, dt, first):
+  for i in prange(nn):
+    m = Vn0[i]*rho
+    for j in range(3):
+      Vt[i,j] += (Ft[i,j] - Vt[i,j]*gamma*Vn0[i])/m*dt
+      Ut[i,j] += Vt[i,j]*dt
+      Ft[i,j] = 0.0
+
+  return Ft, Ut, Vt
+
+# Velocity Verlet, velocities (Vt) are synchronous with positions, the damping term is implicit in the velocity update
+@njit(parallel=True)
+def moveVerlet(nn, Ft, Vt, Ut, Ab, gamma, Vn0, rho, dt, first):
+  c = gamma/rho
+  for i in prange(nn):
+    m = Vn0[i]*rho
+    for j in range(3):
+      fm = Ft[i,j]/m
+      if first:
+        v = Vt[i,j]
+      else:
+        v = (Vt[i,j] + (Ab[i,j] + fm)*0.5*dt)/(1.0 + 0.5*c*dt)
+      acc = fm - c*v
+      Ut[i,j] += v*dt + 0.5*acc*dt*dt
+      Vt[i,j] = v
+      Ab[i,j] = acc
+      Ft[i,j] = 0.0
+
+  return Ft, Ut, Vt
+
+# Damped leapfrog, velocities (Vt) are taken at half steps and the damping term is centred in time
+@njit(parallel=True)
+def moveLeapfrog(nn, Ft, Vt, Ut, Ab, gamma, Vn0, rho, dt, first):
+  c = gamma/rho
+  for i in prange(nn):
+    m = Vn0[i]*rho
+    for j in range(3):
+      Vt[i,j] = ((1.0 - 0.5*c*dt)*Vt[i,j] + Ft[i,j]/m*dt)/(1.0 + 0.5*c*dt)
+      Ut[i,j] += Vt[i,j]*dt
+      Ft[i,j] = 0.0
+
+  return Ft, Ut, Vt
+
+# Available integrators, by name
+integrators = {'euler': moveEuler, 'verlet': moveVerlet, 'leapfrog': moveLeapfrog}
@@ -3,6 +3,7 @@ import math
 import os
 from vapory import *
 from geometry import normalSurfaces
+from surfacemetrics import surfaceArea
 import nibabel as nib
 from scipy import ndimage
 from scipy.interpolate import RegularGridInterpolator
@@ -15,20 +16,14 @@ import slam.io as sio
 # Calculate surface area and mesh volume
 def area_volume(Ut, faces, gr, Vn):
 
-  Area = 0.0
-
-  for i in range(len(faces)):
-    Ntmp = np.cross(Ut[faces[i,1]] - Ut[faces[i,0]], Ut[faces[i,2]] - Ut[faces[i,0]])
-    Area += 0.5*np.linalg.norm(Ntmp)     #*(gr[faces[i,0]] + gr[faces[i,1]] + gr[faces[i,2]])/3.0
-
-  Volume = 0.0
+  Area = surfaceArea(Ut, faces)
 
   Volume = abs(np.sum(Vn[:]))
 
   return Area, Volume
 
-# Writes POV-Ray source files and then output in .png files
-def writePov(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, nsn, zoom, zoom_pos):
+# Writes POV-Ray source files and then output in .png files (N: normals of the surface nodes in deformed state, computed here if not given)
+def writePov(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, nsn, zoom, zoom_pos, N=None):
 
   povname = "%s/pov_H%fAT%f/B%d.png"%(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step)
 
@@ -41,8 +36,9 @@ def writePov(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, S
     print ('Error: Creating directory. ' + foldname)
 
   # Normals in deformed state
-  N_init = np.zeros((nsn,3), dtype = float)
-  N = normalSurfaces(Ut, faces, SNb, len(faces), nsn, N_init)
+  if N is None:
+    N_init = np.zeros((nsn,3), dtype = float)
+    N = normalSurfaces(Ut, faces, SNb, len(faces), nsn, N_init)
 
   #os.path.dirname(povname)
 
@@ -158,18 +154,9 @@ def writeTXT(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, S
     filetxt.write(str(SNb[faces[i][0]]+1) + " " + str(SNb[faces[i][1]]+1) + " " + str(SNb[faces[i][2]]+1) + "\n")
   filetxt.close()
 
-# Convert surface mesh structure (from simulations) to .stl format file
-def mesh_to_stl(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, SN, zoom_pos, cog, maxd, nsn, faces, SNb, miny, halforwholebrain):
-
-  stlname = "B%d.stl"%(step)
-
-  foldname = "%s/pov_H%fAT%f/"%(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE)
-
-  save_path = os.path.join(foldname, stlname)
-
-  # Transform coordinates (because the coordinates are normalized at the beginning)
+# Surface nodes in the coordinates of the input mesh (the coordinates are normalized at the beginning)
+def surfaceCoordinates(Ut, SN, zoom_pos, cog, maxd, nsn, miny, halforwholebrain):
   vertices = np.zeros((nsn,3), dtype = float)
-  f_indices = np.zeros((len(faces),3), dtype = int)
   vertices_seg = np.zeros((nsn,3), dtype = float)
 
   vertices[:,:] = Ut[SN[:],:]*zoom_pos
@@ -183,6 +170,21 @@ def mesh_to_stl(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, SN, zoom_
   vertices_seg[:,2] = cog[2] - vertices[:,2]*maxd
   #vertices_seg[:,2] = vertices[:,2]*maxd + cog[2]
 
+  return vertices_seg
+
+# Convert surface mesh structure (from simulations) to .stl format file
+def mesh_to_stl(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, SN, zoom_pos, cog, maxd, nsn, faces, SNb, miny, halforwholebrain):
+
+  stlname = "B%d.stl"%(step)
+
+  foldname = "%s/pov_H%fAT%f/"%(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE)
+
+  save_path = os.path.join(foldname, stlname)
+
+  # Transform coordinates (because the coordinates are normalized at the beginning)
+  vertices_seg = surfaceCoordinates(Ut, SN, zoom_pos, cog, maxd, nsn, miny, halforwholebrain)
+
+  f_indices = np.zeros((len(faces),3), dtype = int)
   f_indices[:,0] = SNb[faces[:,0]]
   f_indices[:,1] = SNb[faces[:,1]]
   f_indices[:,2] = SNb[faces[:,2]]
@@ -200,6 +202,67 @@ def mesh_to_stl(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, SN, zoom_
   # Write the mesh to file ".stl"
   brain.save(save_path, mode=Mode.ASCII)"""
 
+# Write a surface mesh (vertices, triangles fs in vertex indices) as binary STL: 80-byte header, number of triangles, then per triangle its unit normal, vertices and a 2-byte attribute
+def writeSTL(path, vertices, fs):
+  v = vertices[fs]
+  normals = np.cross(v[:,1] - v[:,0], v[:,2] - v[:,0])
+  length = np.linalg.norm(normals, axis=1)
+  normals /= np.where(length > 0.0, length, 1.0)[:,np.newaxis]
+  records = np.zeros(len(fs), dtype=[('normal', '<f4', (3,)), ('vertices', '<f4', (3,3)), ('attr', '<u2')])
+  records['normal'] = normals
+  records['vertices'] = v
+  with open(path, 'wb') as f:
+    f.write(b'BrainGrowth surface'.ljust(80, b' '))
+    np.array([len(fs)], dtype='<u4').tofile(f)
+    records.tofile(f)
+
+# Write a surface mesh as GIfTI: float32 coordinates (pointset) and int32 triangles
+def writeGIfTI(path, vertices, fs):
+  coords = nib.gifti.GiftiDataArray(np.asarray(vertices, dtype=np.float32), intent='NIFTI_INTENT_POINTSET', datatype='NIFTI_TYPE_FLOAT32')
+  triangles = nib.gifti.GiftiDataArray(np.asarray(fs, dtype=np.int32), intent='NIFTI_INTENT_TRIANGLE', datatype='NIFTI_TYPE_INT32')
+  nib.save(nib.gifti.GiftiImage(darrays=[coords, triangles]), path)
+
+# Write a surface mesh as binary little-endian PLY: float32 vertices, triangles as lists of 3 int32 indices
+def writePLY(path, vertices, fs):
+  header = 'ply\nformat binary_little_endian 1.0\nelement vertex %d\nproperty float x\nproperty float y\nproperty float z\nelement face %d\nproperty list uchar int vertex_indices\nend_header\n'%(len(vertices), len(fs))
+  records = np.zeros(len(fs), dtype=[('count', 'u1'), ('vertices', '<i4', (3,))])
+  records['count'] = 3
+  records['vertices'] = fs
+  with open(path, 'wb') as f:
+    f.write(header.encode('ascii'))
+    np.asarray(vertices, dtype='<f4').tofile(f)
+    records.tofile(f)
+
+# Write a surface mesh as ASCII STL with trimesh, as mesh_to_stl
+def writeSTLascii(path, vertices, fs):
+  mesh = trimesh.Trimesh(vertices=vertices, faces=fs, process=False)
+  mesh.export(path, file_type='stl_ascii')
+
+# Surface mesh writers by format, with the extension of their files
+surfaceWriters = {'stl': (writeSTL, 'stl'),
+                  'stl_ascii': (writeSTLascii, 'stl'),
+                  'gii': (writeGIfTI, 'gii'),
+                  'ply': (writePLY, 'ply')}
+
+# Convert surface mesh structure (from simulations) to surface files B<step>.<extension> in the given formats (see surfaceWriters)
+# The surface triangles fs are in surface node indices (SNb[faces]), built once per run
+def mesh_to_surface(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, SN, zoom_pos, cog, maxd, nsn, fs, miny, halforwholebrain, formats=('stl',)):
+
+  foldname = "%s/pov_H%fAT%f/"%(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE)
+
+  try:
+    if not os.path.exists(foldname):
+      os.makedirs(foldname)
+  except OSError:
+    print ('Error: Creating directory. ' + foldname)
+
+  # Transform coordinates (because the coordinates are normalized at the beginning)
+  vertices_seg = surfaceCoordinates(Ut, SN, zoom_pos, cog, maxd, nsn, miny, halforwholebrain)
+
+  for fmt in formats:
+    writer, extension = surfaceWriters[fmt]
+    writer(os.path.join(foldname, "B%d.%s"%(step, extension)), vertices_seg, fs)
+
 # Convert mesh .stl to image .nii.gz
 def point3d_to_voxel(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, filename_nii_reso, Ut, zoom_pos, maxd, cog, nn, miny):
 
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+  python precisioncheck.py
+  python precisioncheck.py -i './data/sphere5.mesh' -ns 5 -o './res/precisioncheck'
+
+"""
+
+from __future__ import division
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+SIMULATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulation.py')
+
+# Check of the working precisions: simulation.py is run for a few steps with each combination of -pr (positions, velocities, forces) and -rp (reference state of tetrahedra),
+# and must end with finite positions close to those of the float64 run. Snapshot outputs are disabled, the final state is read from the checkpoint of the last step
+
+# Run nsteps steps of simulation.py with precisions pr and rp, returns the final positions, or None if the run failed (its log is kept in outdir)
+def runPrecision(mesh_path, outdir, pr, rp, nsteps, a):
+  if not os.path.exists(outdir):
+    os.makedirs(outdir)
+  with open(os.path.join(outdir, 'log.txt'), 'w') as log:
+    run = subprocess.run([sys.executable, SIMULATION, '-i', mesh_path, '-o', outdir, '-hc', 'whole', '-gm', 'global', '-ms', str(a), '-ns', str(nsteps),
+                          '-pr', pr, '-rp', rp, '-ck', str(nsteps), '-di', '0', '-ow', '0'], stdout=log, stderr=subprocess.STDOUT)
+  if run.returncode != 0:
+    return None
+  with np.load(os.path.join(outdir, 'checkpoint.npz')) as f:
+    return f['Ut'].astype(np.float64)
+
+# Run all the combinations, print the deviation of each from the float64 run (largest node distance, in mesh spacings), returns the combinations that failed
+def checkPrecisions(mesh_path, outdir, nsteps, a, tol):
+  failed = []
+  reference = None
+  for pr, rp in itertools.product(['float64', 'float32'], repeat=2):
+    name = 'pr-' + pr + '-rp-' + rp
+    Ut = runPrecision(mesh_path, os.path.join(outdir, name), pr, rp, nsteps, a)
+    if Ut is None:
+      print (name + ': run failed, see ' + os.path.join(outdir, name, 'log.txt'))
+      failed.append(name)
+      continue
+    if not np.all(np.isfinite(Ut)):
+      print (name + ': non-finite positions after ' + str(nsteps) + ' steps')
+      failed.append(name)
+      continue
+    if reference is None and pr == 'float64' and rp == 'float64':
+      reference = Ut
+    deviation = np.max(np.linalg.norm(Ut - reference, axis=1))/a if reference is not None else float('nan')
+    print (name + ': ' + str(nsteps) + ' steps, deviation from float64 ' + '%.3g' % (deviation) + ' mesh spacings')
+    if deviation > tol:
+      failed.append(name)
+
+  return failed
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Run simulation.py for a few steps with each combination of working (-pr) and reference (-rp) precisions')
+  parser.add_argument('-i', '--input', help='Input maillage', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'sphere5.mesh'), required=False)
+  parser.add_argument('-ns', '--nsteps', help='Steps of each run', type=int, default=5, required=False)
+  parser.add_argument('-ms', '--meshspacing', help='Mesh spacing parameter passed to simulation.py', type=float, default=0.01, required=False)
+  parser.add_argument('-tl', '--tolerance', help='Largest deviation of a node from the float64 run, in mesh spacings', type=float, default=1e-2, required=False)
+  parser.add_argument('-o', '--output', help='Output folder of the runs (default: a temporary folder)', type=str, required=False)
+  args = parser.parse_args()
+
+  failed = checkPrecisions(args.input, args.output or tempfile.mkdtemp(prefix='braingrowth_precision_'), args.nsteps, args.meshspacing, args.tolerance)
+  if failed:
+    print ('Failed: ' + ' '.join(failed))
+    sys.exit(1)
+  print ('All precisions passed')
@@ -0,0 +1,105 @@
+import os
+import csv
+import json
+import time
+import contextlib
+import tracemalloc
+
+# Instrumentation of the simulation loop: wall-clock time per phase, event counters (e.g. contact list rebuilds) and allocation tracking
+# Disabled by default: phase() then returns a shared no-op context, so the instrumented loop only pays for one function call per phase
+
+enabled = False
+memory = False
+totals = {}  # Seconds spent in each phase since the start
+calls = {}  # Number of calls of each phase
+interval = {}  # Seconds spent in each phase since the last summary
+events = {}  # Event counters
+rows = []  # One row per summary, for the CSV log
+clock = [0.0, 0.0]  # Start of the run and of the current summary interval
+noop = contextlib.nullcontext()
+
+# Turn instrumentation on. With memory, Python and NumPy allocations are traced (tracemalloc), and numba allocations are counted when NUMBA_NRT_STATS=1 is set
+def enableProfiling(trackmemory=False):
+  global enabled, memory
+  enabled = True
+  memory = trackmemory
+  if memory:
+    tracemalloc.start()
+  clock[0] = clock[1] = time.perf_counter()
+
+# Context timing one phase of the loop, e.g. "with phase('contact'):"
+def phase(name):
+  if not enabled:
+    return noop
+  return timedPhase(name)
+
+@contextlib.contextmanager
+def timedPhase(name):
+  tic = time.perf_counter()
+  try:
+    yield
+  finally:
+    dt = time.perf_counter() - tic
+    totals[name] = totals.get(name, 0.0) + dt
+    interval[name] = interval.get(name, 0.0) + dt
+    calls[name] = calls.get(name, 0) + 1
+
+# Add n to the event counter name
+def countEvent(name, n=1):
+  if enabled:
+    events[name] = events.get(name, 0) + n
+
+# Allocation statistics: current and peak traced memory in MB, number of numba allocations and frees
+def memoryStats():
+  stats = {}
+  if memory:
+    current, peak = tracemalloc.get_traced_memory()
+    stats['traced_mb'] = current/1e6
+    stats['peak_traced_mb'] = peak/1e6
+  if memory and os.environ.get('NUMBA_NRT_STATS', '0') != '0':
+    from numba.core.runtime import rtsys
+    nrt = rtsys.get_allocation_stats()
+    stats['numba_allocs'] = nrt.alloc
+    stats['numba_frees'] = nrt.free
+
+  return stats
+
+# Print the time spent in each phase since the last summary, and record it as a row of the CSV log (nothing if no phase ran since then)
+def profileSummary(step, t):
+  if not enabled or not interval:
+    return
+  now = time.perf_counter()
+  wall = now - clock[1]
+  clock[1] = now
+  row = {'step': step, 't': t, 'wall': wall}
+  row.update(interval)
+  row['other'] = wall - sum(interval.values())
+  row.update(events)
+  row.update(memoryStats())
+  rows.append(row)
+  print ('Profile at step ' + str(step) + ': ' + ', '.join(name + ' ' + '%.3f' % (interval[name]) + ' s' for name in sorted(interval, key=interval.get, reverse=True)) + ', other ' + '%.3f' % (row['other']) + ' s, wall ' + '%.3f' % (wall) + ' s')
+  if events or memory:
+    print ('Profile counters: ' + ', '.join(name + ' ' + str(row[name]) for name in list(events) + list(memoryStats())))
+  interval.clear()
+
+# Write the timing log of the run: totals per phase in path.json, summary rows in path.csv
+def writeProfile(path):
+  if not enabled:
+    return
+  wall = time.perf_counter() - clock[0]
+  report = {'wall': wall,
+            'phases': {name: {'seconds': totals[name], 'calls': calls[name], 'mean': totals[name]/calls[name], 'fraction': totals[name]/wall if wall > 0.0 else 0.0} for name in totals},
+            'events': events,
+            'memory': memoryStats()}
+  folder = os.path.dirname(path)
+  if folder and not os.path.exists(folder):
+    os.makedirs(folder)
+  with open(path + '.json', 'w') as f:
+    json.dump(report, f, indent=2)
+  fields = []
+  for row in rows:
+    fields += [key for key in row if key not in fields]
+  with open(path + '.csv', 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=fields, restval=0)
+    writer.writeheader()
+    writer.writerows(rows)
@@ -0,0 +1,171 @@
+import numpy as np
+import math
+from numba import njit, prange
+
+# Quasi-static solvers: the nodes are relaxed to mechanical equilibrium at a frozen growth state instead of being integrated in time
+# Forces are given by a function forces(Ut) -> Ft evaluated at the current positions (Ut, updated in place), no energies or stiffness matrices are needed
+
+# Weighted dot product sum_i w[i]*X[i].Y[i] over nodes, accumulated in float64
+@njit(parallel=True)
+def dotNodal(X, Y, w, nn):
+  s = 0.0
+  for i in prange(nn):
+    s += w[i]*(X[i,0]*Y[i,0] + X[i,1]*Y[i,1] + X[i,2]*Y[i,2])
+
+  return s
+
+# Move the nodes along a direction: Ut += alpha*D
+@njit(parallel=True)
+def displaceNodes(Ut, D, alpha, nn):
+  for i in prange(nn):
+    for j in range(3):
+      Ut[i,j] += alpha*D[i,j]
+
+  return Ut
+
+# Diagonal of the stiffness (Laplacian) of the relaxed configuration: sum over the tetrahedra of node j of vol0*|grad(l)|^2, l being the barycentric coordinate of j
+# Gradients of the barycentric coordinates of corners 1, 2, 3 are the rows of inv(Ar) (Arinv), and that of corner 0 is minus their sum
+# The inverse diagonal (w) preconditions the relaxation, so that small and large elements converge alike
+@njit(parallel=True)
+def stiffnessDiagonal(Arinv, vol0, nn, VT_ptr, VT_idx):
+  w = np.zeros(nn, dtype = np.float64)
+  for j in prange(nn):
+    s = 0.0
+    for p in range(VT_ptr[j], VT_ptr[j+1]):
+      i = VT_idx[p]//4
+      c = VT_idx[p]%4
+      g = 0.0
+      for l in range(3):
+        if c == 0:
+          x = -(Arinv[i,0,l] + Arinv[i,1,l] + Arinv[i,2,l])
+        else:
+          x = Arinv[i,c-1,l]
+        g += x*x
+      s += abs(vol0[i])*g
+    w[j] = 1.0/s
+
+  return w
+
+# Relax the nodes (Ut, in place) to equilibrium by matrix-free nonlinear conjugate gradients (Polak-Ribiere, restarted when the direction stops descending)
+# The residual is preconditioned by the inverse stiffness diagonal (w, see stiffnessDiagonal). The line search only uses the directional force g = Ft.D, positive downhill:
+# it steps forward while g stays positive (extrapolating by secants), then falls back on regula falsi once the zero of g is bracketed
+# No node moves by more than maxstep in a line search step. Iterations stop when the preconditioned residual falls below tol times its value at the start,
+# when no nodal force exceeds atol (equilibrium up to rounding, e.g. before growth starts), or after maxit iterations (not converged: the caller should check the relative residual)
+# Nodal volumes (Vn0) carry the orientation of the mesh and the dynamics accelerate nodes along Ft/(rho*Vn0), so the residual is Ft*sign(Vn0)
+# Returns the number of iterations, the number of force evaluations and the relative residual
+def relaxCG(forces, Ut, Vn0, w, nn, maxstep, tol=1e-3, maxit=500, atol=0.0, nsearch=4):
+  one = np.ones(nn, dtype = np.float64)
+  sgn = np.sign(Vn0)[:,np.newaxis]
+  r = forces(Ut)*sgn
+  nfe = 1
+  D = r*w[:,np.newaxis]
+  delta = dotNodal(r, r, w, nn)
+  res0 = math.sqrt(delta)
+
+  step = 0.1*maxstep  # Largest node displacement of the last line search
+  it = 0
+  while it < maxit and math.sqrt(delta) > tol*res0 and np.max(np.abs(r)) > atol:
+    # Line search along D: alpha0 is downhill (g0 > 0), alpha1 uphill (g1 <= 0) once the zero is bracketed
+    dmax = max(np.max(np.abs(D)), 1e-300)
+    amax = maxstep/dmax
+    alpha0 = 0.0
+    g0 = dotNodal(r, D, one, nn)
+    alpha1 = -1.0
+    g1 = 0.0
+    alpha = 0.0
+    trial = min(2.0*step, maxstep)/dmax
+    rold = r
+    for j in range(nsearch):
+      displaceNodes(Ut, D, trial - alpha, nn)
+      alpha = trial
+      r = forces(Ut)*sgn
+      nfe += 1
+      g = dotNodal(r, D, one, nn)
+      if g > 0.0:
+        if alpha1 < 0.0 and g < g0:
+          trial = min(alpha + (alpha - alpha0)*g/(g0 - g), alpha + amax)
+        elif alpha1 < 0.0:
+          trial = alpha + amax
+        alpha0 = alpha
+        g0 = g
+      else:
+        alpha1 = alpha
+        g1 = g
+      if alpha1 >= 0.0:
+        trial = alpha0 + (alpha1 - alpha0)*g0/(g0 - g1)
+      if abs(trial - alpha) < 1e-2*amax:
+        break
+    step = alpha*dmax
+
+    # Polak-Ribiere update of the direction
+    deltaold = delta
+    deltamid = dotNodal(r, rold, w, nn)
+    delta = dotNodal(r, r, w, nn)
+    beta = max((delta - deltamid)/deltaold, 0.0)
+    D = r*w[:,np.newaxis] + beta*D
+    if dotNodal(r, D, one, nn) <= 0.0:
+      D = r*w[:,np.newaxis]
+    it += 1
+
+  return it, nfe, math.sqrt(delta)/max(res0, 1e-300)
+
+# One FIRE step (semi-implicit Euler with masses 1/w, then mixing of the velocities Vt towards the residual r): Vt = (1-alpha)*Vt + alpha*|Vt|*r/|r|, norms being taken over all nodes
+# The largest node displacement is capped to maxstep, returns the largest displacement before the cap and the time step actually applied (Ut += Vt*h, h <= dt)
+@njit(parallel=True)
+def fireStep(Ut, Vt, r, w, nn, dt, alpha, maxstep):
+  vv = 0.0
+  rr = 0.0
+  for i in prange(nn):
+    for j in range(3):
+      Vt[i,j] += r[i,j]*w[i]*dt
+      vv += Vt[i,j]*Vt[i,j]
+      rr += r[i,j]*r[i,j]
+  mix = alpha*math.sqrt(vv/rr) if rr > 0.0 else 0.0
+  dmax = 0.0
+  for i in prange(nn):
+    for j in range(3):
+      Vt[i,j] = (1.0 - alpha)*Vt[i,j] + mix*r[i,j]
+      dmax = max(dmax, abs(Vt[i,j])*dt)
+  h = dt*min(1.0, maxstep/dmax) if dmax > 0.0 else dt
+  for i in prange(nn):
+    for j in range(3):
+      Ut[i,j] += Vt[i,j]*h
+
+  return dmax, h
+
+# Relax the nodes (Ut, in place) to equilibrium by FIRE (fast inertial relaxation engine): damped dynamics whose damping and time step adapt to the relaxation
+# Masses are the stiffness diagonal (1/w, see stiffnessDiagonal), so all nodes relax at similar rates. While the residual does work on the velocities (P = r.Vt > 0) for more than
+# ndelay steps, dt grows by finc up to dtmax and the mixing alpha decays by falpha. Once P <= 0 the nodes are moved back by half of the last step (as applied, after the maxstep cap) and stopped,
+# then dt shrinks by fdec and alpha is reset
+# Same arguments, stopping rules and returns as relaxCG, dt being the initial time step (stable for the largest ratio of stiffness to mass); one iteration is one force evaluation
+def relaxFIRE(forces, Ut, Vn0, w, nn, maxstep, tol=1e-3, maxit=500, atol=0.0, dt=0.1, ndelay=5, finc=1.1, fdec=0.5, alpha0=0.1, falpha=0.99):
+  one = np.ones(nn, dtype = np.float64)
+  sgn = np.sign(Vn0)[:,np.newaxis]
+  Vt = np.zeros((nn,3), dtype = np.float64)
+  r = forces(Ut)*sgn
+  res0 = math.sqrt(dotNodal(r, r, w, nn))
+  res = res0
+  dtmax = 10.0*dt
+  dtmin = 0.02*dt
+  alpha = alpha0
+  npos = 0
+  h = 0.0  # Time step applied by the last FIRE step
+  it = 0
+  while it < maxit and res > tol*res0 and np.max(np.abs(r)) > atol:
+    if dotNodal(r, Vt, one, nn) > 0.0:
+      npos += 1
+      if npos > ndelay:
+        dt = min(dt*finc, dtmax)
+        alpha *= falpha
+    elif it > 0:
+      npos = 0
+      displaceNodes(Ut, Vt, -0.5*h, nn)
+      Vt[:] = 0.0
+      dt = max(dt*fdec, dtmin)
+      alpha = alpha0
+    dmax, h = fireStep(Ut, Vt, r, w, nn, dt, alpha, maxstep)
+    r = forces(Ut)*sgn
+    res = math.sqrt(dotNodal(r, r, w, nn))
+    it += 1
+
+  return it, it + 1, res/max(res0, 1e-300)
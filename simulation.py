@@ -8,15 +8,24 @@
 
 from __future__ import division
 import argparse
+import os
 import numpy as np
 import math
-from geometry import importMesh, vertex, tetraVerticesIndices, triangleIndices, numberSurfaceNodes, edge_length, volume_mesh, markgrowth, configRefer, configDeform, normalSurfaces, tetraNormals, volumeNodal, midPlane, longitLength, paraZoom, tetra_labels_surface_half, tetra_labels_volume_half, Curve_fitting_half, tetra_labels_surface_whole, tetra_labels_volume_whole, Curve_fitting_whole
-from growth import dist2surf, growthRate, cortexThickness, shearModulus, growthTensor_tangen, growthTensor_homo, growthTensor_homo_2, growthTensor_relahomo, growthRate_2_half, growthRate_2_whole
+from geometry import importMesh, loadMesh, vertex, tetraVerticesIndices, triangleIndices, numberSurfaceNodes, vertexTetraCSR, vertexFacesCSR, edge_length, volume_mesh, markgrowth, configRefer, configReferInverse, refreshReferCache, refreshReferCacheSym, configDeform, normalSurfaces, tetraNormals, tangentProjector, volumeNodal, volumeNodalGather, minAltitude, midPlane, longitLength, paraZoom, tetra_labels_surface_half, tetra_labels_volume_half, Curve_fitting_half, tetra_labels_surface_whole, tetra_labels_volume_whole, Curve_fitting_whole
+from growth import dist2surf, growthRate, cortexThickness, shearModulus, growthTensor_tangen, growthTensor_tangenSym, growthTensor_tangenProj, growthTensor_homo, growthTensor_homo_2, growthTensor_relahomo, growthRate_2_half, growthRate_2_whole
 from normalisation import normalise_coord
 from collision_Tallinen import contactProcess
-from mechanics import tetraElasticity, move
-from output import area_volume, writePov, writePov2, writeTXT, mesh_to_stl, point3d_to_voxel, mesh_to_image, stl_to_image, writeTex
+from collision import contactProcess as contactProcessKDTree
+from collision_bvh import contactProcess as contactProcessBVH, createBVH
+from relaxation import relaxCG, relaxFIRE, stiffnessDiagonal
+from mechanics import tetraElasticity, tetraElasticityFused, tetraElasticityVolume, move, integrators, stableTimeStep
+from output import area_volume, writePov, writePov2, writeTXT, mesh_to_stl, mesh_to_surface, surfaceWriters, point3d_to_voxel, mesh_to_image, stl_to_image, writeTex
 from mathfunc import make_2D_array
+from profiling import phase, countEvent, enableProfiling, profileSummary, writeProfile
+from checkpoint import saveCheckpoint, waitCheckpoint, loadCheckpoint
+from asyncoutput import startOutput, submitOutput, finishOutput
+from trajectory import createTrajectory, openTrajectory, truncateTrajectory, appendFrame
+from surfacemetrics import surfaceArea, surfaceMetrics
 from numba import jit, prange
 import slam.io as sio
 
@@ -37,7 +46,46 @@ if __name__ == '__main__':
   parser.add_argument('-sc', '--stepcontrol', help='Step length regulation', type=float, default=0.01, required=False)
   parser.add_argument('-ms', '--meshspacing', help='Average spacing in the mesh', type=float, default=0.01, required=False)
   parser.add_argument('-md', '--massdensity', help='Mass density of brain mesh', type=float, default=0.01, required=False)
+  parser.add_argument('-gt', '--growthtolerance', help='Change of the growth tensor below which the cached relaxed state of a tetrahedron is kept', type=float, default=0.0, required=False)
+  parser.add_argument('-bp', '--broadphase', help='Proximity detection for contacts: compiled linked cells (lists refreshed node by node), Kd-tree or bounding volume hierarchy of the surface triangles (all lists rebuilt when a node moves more than the skin)', type=str, choices=['cells', 'kdtree', 'bvh'], default='cells', required=False)
+  parser.add_argument('-dn', '--deformednormals', help='Update the surface normals driving tangential growth from the deformed surface every N steps (0: normals of the initial surface, computed once)', type=int, default=0, required=False)
+  parser.add_argument('-gs', '--growthsymmetric', help='Store the growth tensors in compact symmetric form (6 floats per tetrahedron)', action='store_true', required=False)
+  parser.add_argument('-cs', '--compactstorage', help='Compact per-tetrahedron state: symmetric growth tensors, reference configuration and tangential projectors not kept during the run', action='store_true', required=False)
+  parser.add_argument('-rp', '--referenceprecision', help='Floating point precision of the reference state of tetrahedra (inverse reference and relaxed configurations, volumes)', type=str, choices=['float64', 'float32'], default='float64', required=False)
+  parser.add_argument('-pr', '--precision', help='Floating point precision of positions, velocities and forces (reductions are accumulated in float64)', type=str, choices=['float64', 'float32'], default='float64', required=False)
+  parser.add_argument('-dc', '--driftcheck', help='Advance a float64 shadow run next to a float32 run and report their drift every N steps (0: no shadow run)', type=int, default=0, required=False)
+  parser.add_argument('-fv', '--fusedvolume', help='Compute nodal volumes within the elastic force pass, volumes of tetrahedra are computed once per step', action='store_true', required=False)
+  parser.add_argument('-ig', '--integrator', help='Time integration of Newton dynamics: semi-implicit Euler, velocity Verlet or damped leapfrog', type=str, choices=sorted(integrators), default='euler', required=False)
+  parser.add_argument('-as', '--adaptivestep', help='Adapt the time step to the stability estimate (element size, shear and contact stiffness) every N steps (0: fixed time step)', type=int, default=0, required=False)
+  parser.add_argument('-db', '--dtbounds', help='With an adaptive time step, dt stays between dt0/dtbounds and dt0*dtbounds, dt0 being the initial time step', type=float, default=10.0, required=False)
+  parser.add_argument('-bm', '--binarymesh', help='Cache the input mesh as binary .npy files next to it, loaded memory-mapped by later runs', action='store_true', required=False)
+  parser.add_argument('-qs', '--quasistatic', help='Quasi-static growth in N increments, the nodes being relaxed to equilibrium after each one (0: explicit dynamics)', type=int, default=0, required=False)
+  parser.add_argument('-rt', '--relaxtolerance', help='Quasi-static relaxation stops when the residual force falls below this fraction of its value at the start of the increment', type=float, default=1e-3, required=False)
+  parser.add_argument('-ri', '--relaxiterations', help='Maximum number of iterations per quasi-static increment (conjugate gradient iterations or FIRE steps)', type=int, default=500, required=False)
+  parser.add_argument('-rm', '--relaxmethod', help='Relaxation of quasi-static increments: nonlinear conjugate gradients or FIRE (damped dynamics with adaptive damping and time step)', type=str, choices=['cg', 'fire'], default='cg', required=False)
+  parser.add_argument('-pf', '--profile', help='Time each phase of the loop and print a summary every N steps, with a timing log (profile.json, profile.csv) in the output folder (0: no instrumentation)', type=int, default=0, required=False)
+  parser.add_argument('-pm', '--profilememory', help='With profiling, also track allocations (tracemalloc, and numba allocations if NUMBA_NRT_STATS=1 is set)', action='store_true', required=False)
+  parser.add_argument('-ns', '--nsteps', help='Stop after N steps (0: run until the end of growth, t = 1)', type=int, default=0, required=False)
+  parser.add_argument('-ck', '--checkpoint', help='Save the state of the run to checkpoint.npz in the output folder every N steps, written in the background (0: no checkpoints)', type=int, default=0, required=False)
+  parser.add_argument('-cz', '--checkpointcompress', help='Compress checkpoints (np.savez_compressed)', action='store_true', required=False)
+  parser.add_argument('-sf', '--surfaceformats', help='Formats of the surface files of snapshot steps: binary STL, ASCII STL, GIfTI, PLY', type=str, nargs='+', choices=sorted(surfaceWriters), default=['stl'], required=False)
+  parser.add_argument('-ow', '--outputworkers', help='Render and write the outputs of snapshot steps (.png, .txt, surface files) in N background workers while the simulation goes on (0: in the loop)', type=int, default=1, required=False)
+  parser.add_argument('-op', '--outputprocesses', help='Background output workers are processes instead of threads', action='store_true', required=False)
+  parser.add_argument('-tj', '--trajectory', help='Store the snapshot steps in a binary trajectory (folder trajectory in the output folder: surface triangles once, then one frame of surface positions per snapshot) instead of .txt and surface files', action='store_true', required=False)
+  parser.add_argument('-tf', '--trajectoryfields', help='Additional fields of the trajectory frames: positions of all nodes, growth tensors, growth texture of the surface nodes (regional growth)', type=str, nargs='*', choices=['Ut', 'G', 'texture'], default=[], required=False)
+  parser.add_argument('-tz', '--trajectorycompress', help='Compress the trajectory frames (zlib), they can then be read one by one but not memory-mapped', action='store_true', required=False)
+  parser.add_argument('-di', '--outputinterval', help='Write the outputs of a snapshot step (.png, .txt, surface files or trajectory frame) every N steps of explicit dynamics (0: no snapshot outputs)', type=int, default=500, required=False)
+  parser.add_argument('-sm', '--surfacemetrics', help='Print the surface area (per region with regional growth) and enclosed volume every N steps, and the gyrification index (convex hull) at the snapshot steps among them (0: no surface metrics)', type=int, default=0, required=False)
+  parser.add_argument('-rs', '--restart', help='Resume the run from a checkpoint, with the same input mesh and options', type=str, required=False)
   args = parser.parse_args()
+  if 'stl' in args.surfaceformats and 'stl_ascii' in args.surfaceformats:
+    parser.error('binary and ASCII STL files have the same name, choose one of them')
+  if 'texture' in args.trajectoryfields and not args.growthmethod.__eq__("regional"):
+    parser.error('the growth texture is only defined with regional growth')
+  if args.compactstorage:
+    args.growthsymmetric = True
+  if args.quasistatic > 0:
+    args.driftcheck = 0  # The float64 shadow run follows the explicit dynamics only
 
   # Parameters to change
   PATH_DIR = args.output # Path of results
@@ -47,20 +95,26 @@ if __name__ == '__main__':
   # Path of mesh
   mesh_path = args.input #"/home/x17wang/Bureau/xiaoyu/Brain_code_and_meshes/week23-3M-tets.mesh"  # "./data/prm001_25W_Rwhite.mesh" #"/home/x17wang/Bureau/xiaoyu/ Brain_code_and_meshes/week23-3M-tets.mesh" #"/home/x17wang/Codes/BrainGrowth/brain_2.mesh"
 
-  # Import mesh, each line as a list
-  mesh = importMesh(mesh_path)
+  # Import mesh: undeformed (Ut0) and deformed (Ut) coordinates of nodes, element indices (tets) and surface triangle indices (faces), with their numbers (nn, ne, nf)
+  # The .mesh file is streamed into preallocated arrays, or binary sidecar files are memory-mapped when they are up to date
+  Ut0, Ut, nn, tets, ne, faces, nf = loadMesh(mesh_path, args.binarymesh)
 
-  # Read nodes, get undeformed coordinates (Ut0) and initialize deformed coordinates (Ut) of all nodes
-  Ut0, Ut, nn = vertex(mesh)
+  # Determine surface nodes and index maps (nsn: number of nodes at the surface, SN: Nodal index map from surface to full mesh, SNb: Nodal index map from full mesh to surface)
+  nsn, SN, SNb = numberSurfaceNodes(faces, nn, nf)
 
-  # Read element indices (tets: index of four vertices of tetrahedra) and get number of elements (ne)
-  tets, ne = tetraVerticesIndices(mesh, nn)
+  # Vertex-to-tetrahedron map (VT_ptr, VT_idx), used to gather per-tetrahedron forces to nodes without write conflicts
+  VT_ptr, VT_idx = vertexTetraCSR(tets, nn)
 
-  # Read surface triangle indices (faces: index of three vertices of triangles) and get number of surface triangles (nf)
-  faces, nf = triangleIndices(mesh, nn, ne)
+  # Surface node-to-triangle map (FN_ptr, FN_idx), used by the Kd-tree proximity detection and to gather contact reactions
+  FN_ptr, FN_idx = vertexFacesCSR(faces, SNb, nsn)
 
-  # Determine surface nodes and index maps (nsn: number of nodes at the surface, SN: Nodal index map from surface to full mesh, SNb: Nodal index map from full mesh to surface)
-  nsn, SN, SNb = numberSurfaceNodes(faces, nn, nf)
+  # Surface triangles in surface node indices, for the surface outputs
+  fs = SNb[faces]
+
+  # Bounding volume hierarchy of the surface triangles, refitted when proximity lists are regenerated and rebuilt when its quality degrades
+  BVH = None
+  if args.broadphase.__eq__("bvh"):
+    BVH = createBVH(Ut, faces, nf)
 
   # Check minimum, maximum and average edge lengths (average mesh spacing) at the surface
   mine, maxe, ave = edge_length(Ut, faces, nf)
@@ -68,14 +122,11 @@ if __name__ == '__main__':
 
   # Calculate the total volume of a tetrahedral mesh
   Vn_init = np.zeros(nn, dtype = np.float64)
-  Vm = volume_mesh(Vn_init, nn, ne, tets, Ut)
+  Vm = volume_mesh(Vn_init, nn, ne, tets, Ut, VT_ptr, VT_idx)
   print ('Volume of mesh is ' + str(-Vm))
 
   # Calculate the total surface area of a tetrahedral mesh
-  Area = 0.0
-  for i in range(len(faces)):
-    Ntmp = np.cross(Ut0[faces[i,1]] - Ut0[faces[i,0]], Ut0[faces[i,2]] - Ut0[faces[i,0]])
-    Area += 0.5*np.linalg.norm(Ntmp)
+  Area = surfaceArea(Ut0, faces)
   print ('Area of mesh is ' + str(Area))
 
   # Parameters
@@ -86,15 +137,20 @@ if __name__ == '__main__':
   a = args.meshspacing #0.003 0.01 Mesh spacing - set manually based on the average spacing in the mesh
   rho = args.massdensity #0.0001 Mass density - adjust to run the simulation faster or slower
   gamma = 0.5 #0.1 Damping coefficent
-  di = 500 #Output data once every di steps
+  di = args.outputinterval #Output data once every di steps (0: never)
 
-  bw = 3.2 #Width of a bounding box, centered at origin, that encloses the whole geometry even after growth ***** TOMODIFY
+  bw = 3.2 #Width of a bounding box, centered at origin, that encloses the whole geometry even after growth (legacy createNNLtriangle only, the compiled linked cells are sized from the surface)
   mw = 8*a #Width of a cell in the linked cell algorithm for proximity detection
   hs = 0.6*a #Thickness of proximity skin
   hc = 0.2*a #Thickness of repulsive skin
   kc = 10.0*K #100.0*K Contact stiffness
   dt = args.stepcontrol*np.sqrt(rho*a*a/K) #0.05*np.sqrt(rho*a*a/K) Time step = 1.11803e-05 // 0,000022361
   print('dt is ' + str(dt))
+  dt0 = dt #Initial time step, the adaptive time step follows the stability estimate relative to its initial value (dtest0)
+  dtest0 = 0.0 #Stability estimate at step 0, set by the adaptive time step
+  if args.quasistatic > 0:
+    dt = 1.0/args.quasistatic #Growth increment of the quasi-static mode
+    di = max(1, int(di*dt0/dt)) if di > 0 else 0 #Output at about the same growth stages as the explicit dynamics
   eps = 0.1 #Epsilon
   k = 0.0
   mpy = -0.004 #Midplane position
@@ -107,17 +163,25 @@ if __name__ == '__main__':
   N0 = np.zeros((nsn,3), dtype = np.float64)  #Normals of surface nodes
   Vt = np.zeros((nn,3), dtype = np.float64)  #Velocities
   Ft = np.zeros((nn,3), dtype = np.float64)  #Forces
+  Fe = np.zeros((4*ne,3), dtype = np.float64)  #Elastic forces at the corners of tetrahedra
+  vol = np.zeros(ne, dtype = np.float64)  #Deformed volumes of tetrahedra
+  Ab = np.zeros((nn,3) if args.integrator.__eq__("verlet") else (0,3), dtype = np.float64)  #Accelerations of the previous step (velocity Verlet)
+  moveStep = integrators[args.integrator]  #Fused time integrator
   #Vn0 = np.zeros(nn, dtype = float) #Nodal volumes in reference state
   #Vn = np.zeros(nn, dtype = float)  #Deformed nodal volumes
   # Ue = 0 #Elastic energy
 
-  NNLt = [[] for _ in range(nsn)] #Triangle-proximity lists for surface nodes
+  NNLt = (np.zeros(nsn+1, dtype = np.int64), np.zeros(0, dtype = np.int64)) #Triangle-proximity lists for surface nodes, in compressed sparse row form (offsets, triangle indices)
   Utold = np.zeros((nsn,3), dtype = np.float64)  #Stores positions when proximity list is updated
+  NNLstats = np.zeros(3, dtype = np.float64)  #Proximity list updates, recomputed node lists and time spent in proximity detection
   #ub = vb = wb = 0 #Barycentric coordinates of triangles
   #G = np.array([np.identity(3)]*ne)  
   shape = (ne,3,3)
   G = np.zeros(shape, dtype = np.float64)  # Initial tangential growth tensor
   G[:,np.arange(3),np.arange(3)] = 1.0
+  if args.growthsymmetric:
+    G = np.zeros((ne,6), dtype = np.float64)  # Compact symmetric storage: xx, yy, zz, xy, xz, yz
+    G[:,0:3] = 1.0
   #G = [1.0]*ne
   #G = 1.0
   # End of parameters
@@ -172,6 +236,16 @@ if __name__ == '__main__':
       texture_file_2 = args.textureleft
       peak, amplitude, latency, peak_2, amplitude_2, latency_2 = Curve_fitting_whole(texture_file, texture_file_2, labels, labels_2, n_clusters, lobes, lobes_2)
 
+  # Region of each surface node for the surface metrics, regions of the left hemisphere being numbered after those of the right one
+  labels_metrics = None
+  if args.growthmethod.__eq__("regional"):
+    if args.halforwholebrain.__eq__("half"):
+      labels_metrics = labels_surface.astype(np.int64)
+    else:
+      labels_metrics = np.zeros(nsn, dtype = np.int64)
+      labels_metrics[indices_a] = labels_surface
+      labels_metrics[indices_b] = labels_surface_2 + labels_surface.max() + 1
+
   # Normalize initial mesh coordinates, change mesh information by values normalized
   Ut0, Ut, cog, maxd, miny = normalise_coord(Ut0, Ut, nn, args.halforwholebrain)
 
@@ -184,12 +258,29 @@ if __name__ == '__main__':
   # Configuration of tetrahedra at reference state (A0)
   A0 = configRefer(Ut0, tets, ne)
 
+  # Inverse and determinant of the reference state (A0inv, detA0), and cache of the relaxed state (Arinv: inverse of G.A0, vol0: relaxed volumes) for the growth tensors Gc
+  # Reference quantities are stored in args.referenceprecision, kernels accumulate in float64
+  A0inv, detA0 = configReferInverse(A0, ne)
+  A0inv_64, detA0_64 = A0inv, detA0  #float64 reference state of the shadow run
+  A0inv = A0inv.astype(args.referenceprecision)
+  detA0 = detA0.astype(args.referenceprecision)
+  Gc = G.copy()
+  Arinv = A0inv.copy()
+  vol0 = detA0/6.0
+  if args.compactstorage:
+    del A0
+
   # Mark non-growing areas
   gr = markgrowth(Ut0, nn)
 
   # Calculate normals of each surface triangle and apply these normals to surface nodes
   N0 = normalSurfaces(Ut0, faces, SNb, nf, nsn, N0)
 
+  # Normals of tetrahedra (Nt) and tangential projectors (Pt = I - outer(Nt, Nt)). csn, tets and N0 do not change, so they are computed once unless deformed normals are requested
+  Nt = tetraNormals(N0, csn, tets, ne)
+  if not args.growthsymmetric:
+    Pt = tangentProjector(Nt, ne)
+
   #num_cores = mp.cpu_count()
   #pool = mp.Pool(mp.cpu_count())
   #H = THICKNESS_CORTEX
@@ -221,97 +312,338 @@ if __name__ == '__main__':
   #filename_nii_reso = "/home/x17wang/Exp/London/London-23weeks/brain_crisp_2_refilled.nii.gz"
   #reso = 0.5
 
-  # Simulation loop
-  while t < 1.0:
-
-    # Calculate the relative growth rate
-    if args.growthmethod.__eq__("regional"):
-      if args.halforwholebrain.__eq__("half"):
-        at, bt = growthRate_2_half(t, ne, nsn, n_clusters, labels_surface, labels_volume, peak, amplitude, latency, lobes)
-      else:
-        at, bt = growthRate_2_whole(t, ne, nsn, n_clusters, labels_surface, labels_surface_2, labels_volume, labels_volume_2, peak, amplitude, latency, peak_2, amplitude_2, latency_2, lobes, lobes_2, indices_a, indices_b, indices_c, indices_d)
-    else:
-      at = growthRate(GROWTH_RELATIVE, t, ne)
-      
-    # Calculate the longitudinal length of the real brain
-    L = longitLength(t)
-
-    # Calculate the thickness of growing layer
-    H = cortexThickness(THICKNESS_CORTEX, t)
-
+  # Calculate contact, elastic and midplane forces, and growth (unless grow is False) for one time step of the state (Ut, Ft, NNLt, G, Arinv, vol0...)
+  # The growth drivers (at, H, Nt) are shared, so a float64 shadow of a float32 run is advanced with the same code
+  def forceProcess(Ut, Ut0, Ft, Fe, NNLt, Utold, NNLstats, BVH, G, Gc, A0inv, detA0, Arinv, vol0, at, H, grow=True):
     # Calculate undeformed nodal volume (Vn0) and deformed nodal volume (Vn)
-    Vn0, Vn = volumeNodal(G, A0, tets, Ut, ne, nn)
-
-    # Initialize elastic energy
-    #Ue = 0.0
-
-    # Calculate elastic forces
-    #Ft = elasticProccess(d2s, H, tets, muw, mug, Ut, A0, Ft, K, k, Vn, Vn0, eps, N0, csn, at, G, ne)
+    if not args.fusedvolume:
+      with phase('nodal volumes'):
+        Vn0, Vn = volumeNodalGather(vol0, tets, Ut, ne, nn, VT_ptr, VT_idx, vol)
 
     # Calculate contact forces
-    Ft, NNLt = contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr)
+    nupdates = NNLstats[0]
+    with phase('contact'):
+      if args.broadphase.__eq__("kdtree"):
+        Ft, NNLt = contactProcessKDTree(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, NNLstats)
+      elif args.broadphase.__eq__("bvh"):
+        Ft, NNLt = contactProcessBVH(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, BVH, NNLstats)
+      else:
+        Ft, NNLt = contactProcess(Ut, Ft, SN, Utold, nsn, NNLt, faces, nf, bw, mw, hs, hc, kc, a, gr, FN_ptr, FN_idx, NNLstats)
+    countEvent('contact list updates', int(NNLstats[0] - nupdates))
     #myfile.write("%s\n" % NNLt)
     # Calculate gray and white matter shear modulus (gm and wm) for a tetrahedron, calculate the global shear modulus
-    gm, mu = shearModulus(d2s, H, tets, ne, muw, mug, gr)
-
-    # Deformed configuration of tetrahedra (At)
-    At = configDeform(Ut, tets, ne)
-
-    # Calculate elastic forces
-    Ft = tetraElasticity(At, A0, Ft, G, K, k, mu, tets, Vn, Vn0, ne, eps)
+    with phase('shear modulus'):
+      gm, mu = shearModulus(d2s, H, tets, ne, muw, mug, gr)
 
-    # Calculate normals of each deformed tetrahedron 
-    Nt = tetraNormals(N0, csn, tets, ne)
+    # Calculate elastic forces, the deformed configuration of tetrahedra (At) is built on the fly
+    with phase('elasticity'):
+      if args.fusedvolume:
+        Ft, Vn0, Vn = tetraElasticityVolume(Ut, tets, Arinv, vol0, Ft, K, k, mu, ne, eps, Fe, VT_ptr, VT_idx, vol)
+      else:
+        Ft = tetraElasticityFused(Ut, tets, Arinv, vol0, Ft, K, k, mu, Vn, Vn0, ne, eps, Fe, VT_ptr, VT_idx)
 
     # Calculate relative tangential growth factor G
-    G = growthTensor_tangen(Nt, gm, at, G, ne)
+    if grow:
+      G, Arinv, vol0 = growthProcess(gm, G, Gc, A0inv, detA0, Arinv, vol0, at)
     #G[i] = growthTensor_homo_2(G, i, GROWTH_RELATIVE)
     #G = 1.0 + GROWTH_RELATIVE*t
 
     # Midplane
-    Ft = midPlane(Ut, Ut0, Ft, SN, nsn, mpy, a, hc, K)
+    with phase('midplane'):
+      Ft = midPlane(Ut, Ut0, Ft, SN, nsn, mpy, a, hc, K)
 
-    # Print step -> Add JL, 20/08/2020
-    print ('step: ' + str(step) + ' t: ' + str(t) )
+    return Ft, NNLt, G, Arinv, vol0, Vn0, Vn
 
-    # Output
-    if step % di == 0:
+  # Calculate relative tangential growth factor G, and refresh the cached relaxed state of tetrahedra whose growth tensor changed
+  def growthProcess(gm, G, Gc, A0inv, detA0, Arinv, vol0, at):
+    with phase('growth tensor'):
+      if args.growthsymmetric:
+        G = growthTensor_tangenSym(Nt, gm, at, G, ne)
+        Arinv, vol0, nrefresh = refreshReferCacheSym(G, A0inv, detA0, Gc, Arinv, vol0, ne, args.growthtolerance)
+      else:
+        G = growthTensor_tangenProj(Pt, gm, at, G, ne)
+        Arinv, vol0, nrefresh = refreshReferCache(G, A0inv, detA0, Gc, Arinv, vol0, ne, args.growthtolerance)
+    countEvent('relaxed states refreshed', int(nrefresh))
 
-      # Write texture of growth in .gii files
-      #writeTex(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, bt)
+    return G, Arinv, vol0
 
-      # Obtain zoom parameter by checking the longitudinal length of the brain model
-      zoom_pos = paraZoom(Ut, SN, L, nsn)
+  # Forces at positions Ut for the quasi-static solver, the growth of the current increment being frozen
+  def staticForces(Ut):
+    global NNLt, Vn0, Vn
+    Ft[:] = 0.0
+    Ft_, NNLt, G_, Arinv_, vol0_, Vn0, Vn = forceProcess(Ut, Ut0, Ft, Fe, NNLt, Utold, NNLstats, BVH, G, Gc, A0inv, detA0, Arinv, vol0, at, H, False)
 
-      # Write .pov files and output mesh in .png files
-      writePov(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, nsn, zoom, zoom_pos)
+    return Ft
 
-      # Write surface mesh output files in .txt files
-      writeTXT(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, nsn, zoom_pos)
+  # State carried by the loop from one step to the next, saved in checkpoints. The relaxed state cache (Arinv, vol0) is rebuilt from the cached growth tensors (Gc) on restart,
+  # and the growth tensors G are recomputed at each step before they are used
+  def checkpointState():
+    state = {'t': t, 'step': step, 'dt': dt, 'Ut': Ut, 'Vt': Vt, 'Ab': Ab, 'Utold': Utold, 'NNLt_ptr': NNLt[0], 'NNLt_idx': NNLt[1], 'NNLstats': NNLstats, 'Gc': Gc, 'cog': cog, 'maxd': maxd, 'miny': miny}
+    if args.adaptivestep > 0 and args.quasistatic == 0:
+      state['dtest0'] = dtest0
+    if args.deformednormals > 0:
+      state['N0'] = N0
+    if BVH is not None:
+      state.update(('BVH' + str(i), x) for i, x in enumerate(BVH))
+    if args.driftcheck > 0:
+      state.update({'Ut_64': Ut_64, 'Vt_64': Vt_64, 'Ab_64': Ab_64, 'Utold_64': Utold_64, 'NNLt_64_ptr': NNLt_64[0], 'NNLt_64_idx': NNLt_64[1], 'NNLstats_64': NNLstats_64, 'Gc_64': Gc_64})
+      if BVH_64 is not None:
+        state.update(('BVH_64' + str(i), x) for i, x in enumerate(BVH_64))
+
+    return state
+
+  # Working precision of positions, velocities and forces, and float64 shadow run (Ut_64, Vt_64...) monitoring the drift of a float32 run
+  if args.driftcheck > 0:
+    Ut0_64 = Ut0.astype(np.float64)
+    Ut_64 = Ut0_64
+    Vt_64 = Vt.astype(np.float64)
+    Ft_64 = Ft.astype(np.float64)
+    Fe_64 = Fe.astype(np.float64)
+    Ab_64 = Ab.copy()
+    NNLt_64 = NNLt
+    Utold_64 = Utold.copy()
+    NNLstats_64 = np.zeros(3, dtype = np.float64)
+    BVH_64 = None if BVH is None else tuple(x.copy() for x in BVH)
+    G_64 = G.copy()
+    Gc_64 = Gc.copy()
+    Arinv_64 = A0inv_64.copy()
+    vol0_64 = detA0_64/6.0
+  Ut0 = Ut0.astype(args.precision, copy=False)
+  Ut = Ut0
+  Vt = Vt.astype(args.precision, copy=False)
+  Ft = Ft.astype(args.precision, copy=False)
+  Fe = Fe.astype(args.precision, copy=False)
+
+  # Resume from a checkpoint: arrays are restored in place (Ut is Ut0 during the run), and the relaxed states of the tetrahedra that grew are recomputed from their cached growth tensors
+  if args.restart:
+    state = loadCheckpoint(args.restart)
+    t = float(state['t'])
+    step = int(state['step'])
+    current = checkpointState()
+    if any(name not in state or np.shape(state[name]) != np.shape(current[name]) for name in current if not name.startswith('NNLt')) or state['Ut'].dtype != Ut.dtype:
+      parser.error('checkpoint ' + args.restart + ' does not match the input mesh and options of this run')
+    for name in current:
+      if isinstance(current[name], np.ndarray) and current[name].ndim > 0 and not name.startswith('NNLt') and not name.startswith('Gc') and name != 'N0':
+        current[name][...] = state[name]
+    dt = float(state['dt'])
+    if 'dtest0' in current:
+      dtest0 = float(state['dtest0'])
+    NNLt = (state['NNLt_ptr'], state['NNLt_idx'])
+    cog, maxd, miny = state['cog'], float(state['maxd']), float(state['miny'])
+    if args.growthsymmetric:
+      Arinv, vol0, nrefresh = refreshReferCacheSym(state['Gc'], A0inv, detA0, Gc, Arinv, vol0, ne, 0.0)
+    else:
+      Arinv, vol0, nrefresh = refreshReferCache(state['Gc'], A0inv, detA0, Gc, Arinv, vol0, ne, 0.0)
+    G[...] = Gc
+    if args.deformednormals > 0:
+      N0 = state['N0']
+      Nt = tetraNormals(N0, csn, tets, ne)
+      if not args.growthsymmetric:
+        Pt = tangentProjector(Nt, ne)
+    if args.driftcheck > 0:
+      NNLt_64 = (state['NNLt_64_ptr'], state['NNLt_64_idx'])
+      if args.growthsymmetric:
+        Arinv_64, vol0_64, nrefresh = refreshReferCacheSym(state['Gc_64'], A0inv_64, detA0_64, Gc_64, Arinv_64, vol0_64, ne, 0.0)
+      else:
+        Arinv_64, vol0_64, nrefresh = refreshReferCache(state['Gc_64'], A0inv_64, detA0_64, Gc_64, Arinv_64, vol0_64, ne, 0.0)
+      G_64[...] = Gc_64
+    print ('Restarted from ' + args.restart + ' at step ' + str(step) + ' t: ' + str(t))
+
+  # Trajectory of the snapshot steps: frames of the surface positions (Ut[SN], normalized coordinates) and of the requested fields. A restarted run appends to the
+  # trajectory of the checkpointed run, after dropping the frames written past the checkpoint
+  if args.trajectory:
+    fields = {'surface': ((nsn,3), Ut.dtype)}
+    if 'Ut' in args.trajectoryfields:
+      fields['Ut'] = ((nn,3), Ut.dtype)
+    if 'G' in args.trajectoryfields:
+      fields['G'] = (G.shape, G.dtype)
+    if 'texture' in args.trajectoryfields:
+      fields['texture'] = ((nsn,), np.float64)
+    if args.restart and os.path.exists(PATH_DIR + '/trajectory/meta.json'):
+      trajectory = openTrajectory(PATH_DIR + '/trajectory')
+      trajectory = truncateTrajectory(trajectory, sum(1 for s in trajectory['meta']['scalars']['step'] if s < step))
+    else:
+      trajectory = createTrajectory(PATH_DIR + '/trajectory', fs, fields, {'cog': [float(x) for x in cog], 'maxd': float(maxd), 'miny': float(miny), 'halforwholebrain': args.halforwholebrain, 'thickness': THICKNESS_CORTEX, 'growth': GROWTH_RELATIVE}, args.trajectorycompress)
 
-      # Convert surface mesh structure (from simulations) to .stl format file
-      mesh_to_stl(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, SN, zoom_pos, cog, maxd, nsn, faces, SNb, miny, args.halforwholebrain)
+  # Background output workers
+  if args.outputworkers > 0:
+    startOutput(args.outputworkers, args.outputprocesses)
 
-      # Convert mesh .stl to image .nii.gz
-      #stl_to_image(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, filename_nii_reso, reso)
+  # Instrumentation of the loop
+  if args.profile > 0:
+    enableProfiling(args.profilememory)
 
-      # Convert 3d points to image voxel
-      #point3d_to_voxel(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, filename_nii_reso, Ut, zoom_pos, maxd, cog, nn, miny)
+  checkpointdue = False  # Checkpoint deferred while the previous one is being written
 
-      # Convert volumetric mesh structure (from simulations) to image .nii.gz of a specific resolution
-      #mesh_to_image(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, filename_nii_reso, reso, Ut, zoom_pos, cog, maxd, nn, faces, tets, miny)
+  # Simulation loop
+  while t < 1.0 and (args.nsteps == 0 or step < args.nsteps):
 
-      print ('step: ' + str(step) + ' t: ' + str(t) )
+    # Calculate the relative growth rate
+    with phase('growth rate'):
+      if args.growthmethod.__eq__("regional"):
+        if args.halforwholebrain.__eq__("half"):
+          at, bt = growthRate_2_half(t, ne, nsn, n_clusters, labels_surface, labels_volume, peak, amplitude, latency, lobes)
+        else:
+          at, bt = growthRate_2_whole(t, ne, nsn, n_clusters, labels_surface, labels_surface_2, labels_volume, labels_volume_2, peak, amplitude, latency, peak_2, amplitude_2, latency_2, lobes, lobes_2, indices_a, indices_b, indices_c, indices_d)
+      else:
+        at = growthRate(GROWTH_RELATIVE, t, ne)
+      
+    # Calculate the longitudinal length of the real brain
+    L = longitLength(t)
+
+    # Calculate the thickness of growing layer
+    H = cortexThickness(THICKNESS_CORTEX, t)
+
+    # Update normals of surface nodes and tetrahedra from the deformed surface every args.deformednormals steps
+    if args.deformednormals > 0 and step > 0 and step % args.deformednormals == 0:
+      with phase('normals'):
+        N0 = normalSurfaces(Ut, faces, SNb, nf, nsn, np.zeros((nsn,3), dtype = np.float64))
+        Nt = tetraNormals(N0, csn, tets, ne)
+        if not args.growthsymmetric:
+          Pt = tangentProjector(Nt, ne)
+
+    # Calculate elastic forces
+    #Ft = elasticProccess(d2s, H, tets, muw, mug, Ut, A0, Ft, K, k, Vn, Vn0, eps, N0, csn, at, G, ne)
+
+    # Quasi-static growth increment: growth, then relaxation of the nodes to equilibrium (the force evaluations of the relaxation are timed by phase)
+    if args.quasistatic > 0:
+      with phase('shear modulus'):
+        gm, mu = shearModulus(d2s, H, tets, ne, muw, mug, gr)
+      G, Arinv, vol0 = growthProcess(gm, G, Gc, A0inv, detA0, Arinv, vol0, at)
+      with phase('nodal volumes'):
+        Vn0, Vn = volumeNodalGather(vol0, tets, Ut, ne, nn, VT_ptr, VT_idx, vol)
+        w = stiffnessDiagonal(Arinv, vol0, nn, VT_ptr, VT_idx)
+      if args.relaxmethod.__eq__("fire"):
+        nit, nfe, res = relaxFIRE(staticForces, Ut, Vn0, w, nn, hc, args.relaxtolerance, args.relaxiterations, 1e-9*K*a*a, 0.1/np.sqrt(K + 4.0/3.0*np.max(mu)))
+      else:
+        nit, nfe, res = relaxCG(staticForces, Ut, Vn0, w, nn, hc, args.relaxtolerance, args.relaxiterations, 1e-9*K*a*a)
+      countEvent('relaxation force evaluations', nfe)
+      print ('increment: ' + str(step) + ' ' + args.relaxmethod + ' iterations: ' + str(nit) + ' force evaluations: ' + str(nfe) + ' relative residual: ' + str(res))
+      if nit >= args.relaxiterations and res > args.relaxtolerance:  # Stopped by the iteration cap, not at equilibrium
+        countEvent('unconverged relaxations')
+        print ('Warning: increment ' + str(step) + ' not converged, relative residual ' + str(res) + ' above ' + str(args.relaxtolerance) + ' after ' + str(nit) + ' iterations (raise -ri or -qs)')
+
+    # Calculate contact, elastic and midplane forces, and growth
+    else:
+      Ft, NNLt, G, Arinv, vol0, Vn0, Vn = forceProcess(Ut, Ut0, Ft, Fe, NNLt, Utold, NNLstats, BVH, G, Gc, A0inv, detA0, Arinv, vol0, at, H)
+    if args.driftcheck > 0:
+      Ft_64, NNLt_64, G_64, Arinv_64, vol0_64, Vn0_64, Vn_64 = forceProcess(Ut_64, Ut0_64, Ft_64, Fe_64, NNLt_64, Utold_64, NNLstats_64, BVH_64, G_64, Gc_64, A0inv_64, detA0_64, Arinv_64, vol0_64, at, H)
 
-      # Calculate surface area and mesh volume
-      Area, Volume = area_volume(Ut, faces, gr, Vn)
+    # Print step -> Add JL, 20/08/2020
+    print ('step: ' + str(step) + ' t: ' + str(t) )
 
-      print ('Normalized area: ' + str(Area) + ' Normalized volume: ' + str(Volume) )
+    # Output
+    if di > 0 and step % di == 0:
+      with phase('output'):
+        # Write texture of growth in .gii files
+        #writeTex(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, bt)
+
+        # Obtain zoom parameter by checking the longitudinal length of the brain model
+        zoom_pos = paraZoom(Ut, SN, L, nsn)
+
+        # Queue the .png, .txt and surface outputs of a snapshot of the surface to the background workers
+        if args.outputworkers > 0:
+          submitOutput(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, fs, nsn, zoom, zoom_pos, cog, maxd, miny, args.halforwholebrain, not args.trajectory, args.surfaceformats)
+        else:
+          # Write .pov files and output mesh in .png files
+          writePov(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, nsn, zoom, zoom_pos)
+
+          if not args.trajectory:
+            # Write surface mesh output files in .txt files
+            writeTXT(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, faces, SN, SNb, nsn, zoom_pos)
+
+            # Convert surface mesh structure (from simulations) to surface files (.stl, .gii, .ply)
+            mesh_to_surface(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, Ut, SN, zoom_pos, cog, maxd, nsn, fs, miny, args.halforwholebrain, args.surfaceformats)
+
+        # Append a frame to the trajectory
+        if args.trajectory:
+          frame = {'surface': Ut[SN]}
+          if 'Ut' in args.trajectoryfields:
+            frame['Ut'] = Ut
+          if 'G' in args.trajectoryfields:
+            frame['G'] = G
+          if 'texture' in args.trajectoryfields:
+            frame['texture'] = bt
+          appendFrame(trajectory, frame, {'step': step, 't': t, 'zoom_pos': zoom_pos})
+
+        # Convert mesh .stl to image .nii.gz
+        #stl_to_image(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, filename_nii_reso, reso)
+
+        # Convert 3d points to image voxel
+        #point3d_to_voxel(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, filename_nii_reso, Ut, zoom_pos, maxd, cog, nn, miny)
+
+        # Convert volumetric mesh structure (from simulations) to image .nii.gz of a specific resolution
+        #mesh_to_image(PATH_DIR, THICKNESS_CORTEX, GROWTH_RELATIVE, step, filename_nii_reso, reso, Ut, zoom_pos, cog, maxd, nn, faces, tets, miny)
+
+        print ('step: ' + str(step) + ' t: ' + str(t) )
+
+        # Calculate surface area and mesh volume
+        Area, Volume = area_volume(Ut, faces, gr, Vn)
+
+        print ('Normalized area: ' + str(Area) + ' Normalized volume: ' + str(Volume) )
+
+        print ('Proximity list updates: ' + str(int(NNLstats[0])) + ' recomputed node lists: ' + str(int(NNLstats[1])) + ' time: ' + str(NNLstats[2]) + ' s')
+
+    # Surface area (per region) and enclosed volume of the deformed surface, and its gyrification index at snapshot steps (the convex hull costs more than the rest)
+    if args.surfacemetrics > 0 and step % args.surfacemetrics == 0:
+      with phase('surface metrics'):
+        area, regions, enclosed, gi = surfaceMetrics(Ut, faces, SN, SNb, labels_metrics, di > 0 and step % di == 0)
+      print ('Surface metrics at step ' + str(step) + ': area ' + str(area) + ' enclosed volume ' + str(enclosed) + ('' if gi is None else ' gyrification index ' + str(gi)))
+      if regions is not None:
+        print ('Area per region: ' + ' '.join('%.6g' % (x) for x in regions))
+
+    # Drift of the run with respect to the float64 shadow run, relative to the mesh spacing
+    if args.driftcheck > 0 and step % args.driftcheck == 0:
+      drift = np.linalg.norm(Ut.astype(np.float64) - Ut_64, axis=1)
+      print ('Drift from float64 shadow run: max ' + str(np.max(drift)/a) + ' rms ' + str(np.sqrt(np.mean(drift**2))/a) + ' (mesh spacings)')
+
+    # Adaptive time step: rescale dt with the stability estimate, shrinking by at most a factor 2 and growing by at most 10% at a time
+    if args.adaptivestep > 0 and args.quasistatic == 0 and step % args.adaptivestep == 0:
+      with phase('time step'):
+        gm, mu = shearModulus(d2s, H, tets, ne, muw, mug, gr)
+        dtest = stableTimeStep(minAltitude(Ut, tets, ne), np.max(mu), K, kc, a, hc, rho, rho*np.min(np.abs(Vn0[SN])))
+      if step == 0:
+        dtest0 = dtest
+      dt = min(max(dt0*dtest/dtest0, 0.5*dt, dt0/args.dtbounds), 1.1*dt, dt0*args.dtbounds)
+      print ('step: ' + str(step) + ' stable time step estimate: ' + str(dtest) + ' dt: ' + str(dt))
 
     # Newton dynamics
-    Ft, Ut, Vt = move(nn, Ft, Vt, Ut, gamma, Vn0, rho, dt)
+    with phase('integration'):
+      if args.quasistatic == 0:
+        Ft, Ut, Vt = moveStep(nn, Ft, Vt, Ut, Ab, gamma, Vn0, rho, dt, step == 0)
+      if args.driftcheck > 0:
+        Ft_64, Ut_64, Vt_64 = moveStep(nn, Ft_64, Vt_64, Ut_64, Ab_64, gamma, Vn0_64, rho, dt, step == 0)
 
     t += dt
     step += 1
 
+    # Time spent in each phase since the last summary, and timing log of the run
+    if args.profile > 0 and step % args.profile == 0:
+      profileSummary(step, t)
+      writeProfile(PATH_DIR + '/profile')
+
+    # Checkpoint: the loop only waits for the copy of the state, the file is written in the background. While the previous file is still being written,
+    # the checkpoint is deferred to the next steps instead of waiting for it
+    if args.checkpoint > 0 and (step % args.checkpoint == 0 or checkpointdue):
+      with phase('checkpoint'):
+        snapshot = saveCheckpoint(PATH_DIR + '/checkpoint.npz', checkpointState(), args.checkpointcompress)
+      if snapshot is not None:
+        print ('Checkpoint at step ' + str(step) + ' (state copied in ' + '%.1f' % (1e3*snapshot) + ' ms)')
+      elif not checkpointdue:
+        countEvent('deferred checkpoints')
+        print ('Checkpoint at step ' + str(step) + ' deferred, the previous one is still being written')
+      checkpointdue = snapshot is None
+
+  # A checkpoint still deferred at the end of the run is saved once the previous write is done
+  if checkpointdue:
+    waitCheckpoint()
+    saveCheckpoint(PATH_DIR + '/checkpoint.npz', checkpointState(), args.checkpointcompress)
+    print ('Checkpoint at step ' + str(step))
+  waitCheckpoint()
+  with phase('output'):
+    finishOutput()
+  if args.profile > 0 and step % args.profile != 0:  # Last steps since the last summary, unless the run ended on one
+    profileSummary(step, t)
+    writeProfile(PATH_DIR + '/profile')
+
   #myfile.close()
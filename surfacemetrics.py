@@ -0,0 +1,61 @@
+import numpy as np
+import math
+from numba import njit, prange
+from scipy.spatial import ConvexHull
+
+# Metrics of the brain surface: total area, area of each region, enclosed volume and gyrification index
+# Triangles are given in mesh node indices (faces), the regions by a label per surface node (SNb maps mesh nodes to surface nodes)
+
+# Area and signed volume of the tetrahedron (origin, triangle) of each surface triangle, in one parallel pass. The signed volumes add up to the enclosed volume
+@njit(parallel=True)
+def triangleAreaVolume(Ut, faces, nf):
+  area = np.zeros(nf, dtype=np.float64)
+  vol = np.zeros(nf, dtype=np.float64)
+  for i in prange(nf):
+    a = faces[i,0]
+    b = faces[i,1]
+    c = faces[i,2]
+    ux = Ut[b,0] - Ut[a,0]
+    uy = Ut[b,1] - Ut[a,1]
+    uz = Ut[b,2] - Ut[a,2]
+    vx = Ut[c,0] - Ut[a,0]
+    vy = Ut[c,1] - Ut[a,1]
+    vz = Ut[c,2] - Ut[a,2]
+    nx = uy*vz - uz*vy
+    ny = uz*vx - ux*vz
+    nz = ux*vy - uy*vx
+    area[i] = 0.5*math.sqrt(nx*nx + ny*ny + nz*nz)
+    vol[i] = (Ut[a,0]*nx + Ut[a,1]*ny + Ut[a,2]*nz)/6.0
+
+  return area, vol
+
+# Total area of the surface
+def surfaceArea(Ut, faces):
+  area, vol = triangleAreaVolume(Ut, faces, len(faces))
+
+  return np.sum(area)
+
+# Area of each region: a third of the area of each triangle goes to the label of each of its nodes (labels: per surface node, from 0 to nlabels - 1)
+@njit
+def regionAreas(area, faces, SNb, labels, nlabels):
+  regions = np.zeros(nlabels, dtype=np.float64)
+  for i in range(len(faces)):
+    for j in range(3):
+      regions[labels[SNb[faces[i,j]]]] += area[i]/3.0
+
+  return regions
+
+# Gyrification index: area of the surface over the area of its convex hull
+def gyrificationIndex(Ut, SN, area):
+  return area/ConvexHull(Ut[SN]).area
+
+# Total area, area per region (with labels, else None), enclosed volume and, with hull, gyrification index (else None) of the surface
+def surfaceMetrics(Ut, faces, SN, SNb, labels=None, hull=True):
+  area, vol = triangleAreaVolume(Ut, faces, len(faces))
+  total = np.sum(area)
+  regions = None
+  if labels is not None:
+    regions = regionAreas(area, faces, SNb, labels, int(np.max(labels)) + 1)
+  gi = gyrificationIndex(Ut, SN, total) if hull else None
+
+  return total, regions, abs(np.sum(vol)), gi
@@ -0,0 +1,115 @@
+import os
+import json
+import zlib
+import numpy as np
+
+# Trajectory store: the snapshots of a run in one folder, the surface triangles being stored once (faces.npy) and each field (e.g. surface positions) in one binary file
+# of frames appended one after the other (<field>.bin). meta.json lists the fields (shape and dtype of a frame), the per-frame scalars (step, t...) and, with zlib compression,
+# the offset and size of each frame. meta.json is replaced atomically after the frame data is written, so frames past its count (a crash during a write) are ignored
+# Uncompressed fields can be memory-mapped as (frames, ...) arrays and sliced, compressed frames are read one at a time
+
+# Write the metadata of a store
+def writeMeta(store):
+  tmp = os.path.join(store['path'], 'meta.json.tmp')
+  with open(tmp, 'w') as f:
+    json.dump(store['meta'], f)
+  os.replace(tmp, os.path.join(store['path'], 'meta.json'))
+
+# Create an empty store at path (an existing one is overwritten): faces of the surface, fields as {name: (frame shape, dtype)}, attributes of the run (e.g. normalization constants)
+def createTrajectory(path, faces, fields, attrs=None, compress=False):
+  if not os.path.exists(path):
+    os.makedirs(path)
+  np.save(os.path.join(path, 'faces.npy'), faces)
+  meta = {'nframes': 0, 'compress': compress, 'attrs': attrs or {}, 'scalars': {},
+          'fields': {name: {'shape': [int(n) for n in shape], 'dtype': np.dtype(dtype).name} for name, (shape, dtype) in fields.items()},
+          'offsets': {name: [] for name in fields}}
+  for name in fields:
+    open(os.path.join(path, name + '.bin'), 'wb').close()
+  store = {'path': path, 'meta': meta}
+  writeMeta(store)
+
+  return store
+
+# Open an existing store
+def openTrajectory(path):
+  with open(os.path.join(path, 'meta.json')) as f:
+    meta = json.load(f)
+
+  return {'path': path, 'meta': meta}
+
+# Size in bytes of a frame of an uncompressed field
+def frameBytes(spec):
+  return int(np.prod(spec['shape']))*np.dtype(spec['dtype']).itemsize
+
+# Keep the first nframes frames of a store, e.g. those before the step of a restart, and drop the data of the others
+def truncateTrajectory(store, nframes):
+  meta = store['meta']
+  nframes = min(nframes, meta['nframes'])
+  for name, spec in meta['fields'].items():
+    if meta['compress']:
+      del meta['offsets'][name][nframes:]
+      end = sum(size for offset, size in meta['offsets'][name])
+    else:
+      end = nframes*frameBytes(spec)
+    with open(os.path.join(store['path'], name + '.bin'), 'r+b') as f:
+      f.truncate(end)
+  for key in meta['scalars']:
+    del meta['scalars'][key][nframes:]
+  meta['nframes'] = nframes
+  writeMeta(store)
+
+  return store
+
+# Append a frame: arrays as {field: array} for all the fields of the store, scalars as {name: value} (e.g. step and t)
+def appendFrame(store, arrays, scalars):
+  meta = store['meta']
+  for name, spec in meta['fields'].items():
+    data = np.ascontiguousarray(arrays[name], dtype=spec['dtype'])
+    if list(data.shape) != spec['shape']:
+      raise ValueError('frame of ' + name + ' has shape ' + str(data.shape) + ', expected ' + str(tuple(spec['shape'])))
+    raw = data.tobytes()
+    if meta['compress']:
+      raw = zlib.compress(raw, 1)
+    with open(os.path.join(store['path'], name + '.bin'), 'r+b') as f:
+      if meta['compress']:
+        last = meta['offsets'][name][-1] if meta['offsets'][name] else [0, 0]
+        offset = last[0] + last[1]
+        meta['offsets'][name].append([offset, len(raw)])
+      else:
+        offset = meta['nframes']*frameBytes(spec)
+      f.seek(offset)
+      f.write(raw)
+      f.truncate()
+  for key, value in scalars.items():
+    meta['scalars'].setdefault(key, [None]*meta['nframes']).append(value)
+  meta['nframes'] += 1
+  writeMeta(store)
+
+# Surface triangles of the store (memory-mapped)
+def trajectoryFaces(store):
+  return np.load(os.path.join(store['path'], 'faces.npy'), mmap_mode='r')
+
+# Frame i of a field (negative indices count from the end)
+def readFrame(store, name, i):
+  meta = store['meta']
+  spec = meta['fields'][name]
+  i = range(meta['nframes'])[i]
+  if not meta['compress']:
+    return np.array(trajectoryArray(store, name)[i])
+  offset, size = meta['offsets'][name][i]
+  with open(os.path.join(store['path'], name + '.bin'), 'rb') as f:
+    f.seek(offset)
+    raw = zlib.decompress(f.read(size))
+
+  return np.frombuffer(raw, dtype=spec['dtype']).reshape(spec['shape']).copy()
+
+# All the frames of an uncompressed field, as a read-only memory-mapped (frames, ...) array
+def trajectoryArray(store, name):
+  meta = store['meta']
+  if meta['compress']:
+    raise ValueError('compressed trajectory ' + store['path'] + ' cannot be memory-mapped, read frames with readFrame')
+  spec = meta['fields'][name]
+  if meta['nframes'] == 0:
+    return np.zeros([0] + spec['shape'], dtype=spec['dtype'])
+
+  return np.memmap(os.path.join(store['path'], name + '.bin'), dtype=spec['dtype'], mode='r', shape=tuple([meta['nframes']] + spec['shape']))